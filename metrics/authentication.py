@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.encoding import force_text
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+TOKEN_CACHE_KEY = 'metrics:token:{}'
+
+
+class TokenCache(object):
+    """
+    Bounded LRU of resolved token keys to (user, token), each entry expiring after
+    METRICS_TOKEN_CACHE_TTL seconds. If METRICS_TOKEN_CACHE_ALIAS names a Django cache, it's
+    shared by all the processes and consulted on a local miss. A revoked token is dropped from
+    this process and the shared cache right away, other processes can keep it for up to the TTL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'METRICS_TOKEN_CACHE_TTL', 60)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'METRICS_TOKEN_CACHE_SIZE', 10000)
+
+    def shared_cache(self):
+        alias = getattr(settings, 'METRICS_TOKEN_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                self._entries[key] = entry
+                return entry[1]
+        shared_cache = self.shared_cache()
+        if shared_cache is None:
+            return None
+        credentials = shared_cache.get(TOKEN_CACHE_KEY.format(key))
+        if credentials is not None:
+            self._store(key, credentials)
+        return credentials
+
+    def set(self, key, credentials):
+        self._store(key, credentials)
+        shared_cache = self.shared_cache()
+        if shared_cache is not None:
+            shared_cache.set(TOKEN_CACHE_KEY.format(key), credentials, self.ttl)
+
+    def revoke(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        shared_cache = self.shared_cache()
+        if shared_cache is not None:
+            shared_cache.delete(TOKEN_CACHE_KEY.format(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key, credentials):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, credentials)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+token_cache = TokenCache()
+
+
+def revoke_token(key):
+    token_cache.revoke(force_text(key))
+
+
+@receiver(post_delete, sender=Token)
+@receiver(post_save, sender=Token)
+def revoke_changed_token(sender, instance, **kwargs):
+    revoke_token(instance.key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that keeps resolved tokens in token_cache, so the metrics endpoints don't
+    join the token and user tables on every ping. Users deactivated elsewhere are accepted until
+    their entry expires, unless revoke_token is called.
+    """
+
+    def authenticate_credentials(self, key):
+        key = force_text(key)
+        credentials = token_cache.get(key)
+        if credentials is None:
+            credentials = super(CachedTokenAuthentication, self).authenticate_credentials(key)
+            token_cache.set(key, credentials)
+        return credentials
@@ -0,0 +1,94 @@
+import datetime
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .cache import get_metrics_cache
+from .models import UserVideoMetric
+from .periods import today
+from .views import artist_counts, event_counts, event_series, event_totals
+
+
+def report_calls(event_ids, recording_ids):
+    """
+    (name, callable) pairs running every MetricsManager report, the first ids being the most
+    played ones with the data of UserVideoMetric.objects.create_random_bulk.
+    """
+    now = today()
+    metrics = UserVideoMetric.objects
+    return [
+        ('date_counts', lambda: metrics.date_counts(now.month, now.year)),
+        ('date_counts for an event', lambda: metrics.date_counts(now.month, now.year, event_ids[:1])),
+        ('date_counts for an artist', lambda: metrics.date_counts(now.month, now.year, event_ids[:5])),
+        ('date_series by month for an artist',
+         lambda: metrics.date_series(now - datetime.timedelta(days=365), now, 'month', event_ids[:5])),
+        ('total_archive_counts', lambda: metrics.total_archive_counts(trends=True)),
+        ('counts_for_event', lambda: metrics.counts_for_event(event_ids[0])),
+        ('counts_for_events for 20 events', lambda: metrics.counts_for_events(event_ids[:20])),
+        ('all_time_for_artist', lambda: metrics.all_time_for_artist(event_ids[:5])),
+        ('counts_for_artist', lambda: metrics.counts_for_artist(recording_ids[:5])),
+        ('counts_for_recording', lambda: metrics.counts_for_recording(recording_ids[0], trends=True)),
+        ('this_week_counts', lambda: metrics.this_week_counts(event_ids[:5], trends=True)),
+        ('this_month_counts', lambda: metrics.this_month_counts(event_ids[:5], trends=True)),
+        ('seconds_played_for_all_events',
+         lambda: list(metrics.seconds_played_for_all_events(now - datetime.timedelta(days=30), now))),
+        ('top_week_events', lambda: metrics.top_week_events(trends=True)),
+        ('top_all_time_events for an artist', lambda: list(metrics.top_all_time_events(event_ids[:5]))),
+        ('most_popular week', lambda: list(metrics.most_popular(weekly=True))),
+        ('most_popular_audio month', lambda: list(metrics.most_popular_audio(range_size='month'))),
+        ('most_popular_video year', lambda: list(metrics.most_popular_video(range_size='year'))),
+    ]
+
+
+def view_calls(user, event_ids):
+    """
+    (name, callable) pairs requesting every report view as user.
+    """
+    now = today()
+    factory = APIRequestFactory()
+    month = {'month': now.month, 'year': now.year}
+    year_by_day = {'start': now - datetime.timedelta(days=365), 'end': now, 'granularity': 'day'}
+
+    def get(view, params):
+        def call():
+            request = factory.get('/', params)
+            force_authenticate(request, user=user)
+            response = view(request)
+            response.render()
+            return response
+        return call
+
+    return [
+        ('EventCountsView', get(event_counts, month)),
+        ('EventCountsView for an event', get(event_counts, dict(month, event_id=event_ids[0]))),
+        ('ArtistCountsView', get(artist_counts, dict(month, event_id=event_ids[:5]))),
+        ('EventTotalsView for 20 events', get(event_totals, {'event_id': event_ids[:20]})),
+        ('EventCountsView columnar', get(event_counts, dict(month, format='columnar'))),
+        ('EventSeriesView by week', get(event_series, {
+            'start': now - datetime.timedelta(days=365), 'end': now, 'granularity': 'week'})),
+        ('EventSeriesView by day', get(event_series, year_by_day)),
+        ('EventSeriesView by day columnar', get(event_series, dict(year_by_day, format='columnar'))),
+    ]
+
+
+def time_call(call, repeat=3):
+    """
+    Runs call repeat times with an empty metrics cache and returns the fastest and median wall time
+    in milliseconds and the number of queries of the last run. The metrics cache is cleared before
+    every run, so it shouldn't be one the site shares.
+    """
+    timings = []
+    for _ in range(repeat):
+        get_metrics_cache().clear()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            call()
+            timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return {
+        'min_ms': round(timings[0], 3),
+        'median_ms': round(timings[len(timings) // 2], 3),
+        'queries': len(queries),
+    }
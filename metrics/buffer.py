@@ -0,0 +1,140 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache import bump_archive_versions
+from .models import UserVideoMetric
+from .pings import add_delta, check_ping, load_states, ping_key
+
+logger = logging.getLogger(__name__)
+
+
+class PingBuffer(object):
+    """
+    Write-behind aggregator for player pings. Pings are validated against the known row state
+    (stored values plus whatever is still pending) and merged in memory per
+    recording/recording type/event/user/day, then flushed as one bulk upsert every
+    METRICS_BUFFER_FLUSH_INTERVAL seconds or once METRICS_BUFFER_MAX_ENTRIES rows are pending.
+
+    The state is per process, so with several workers a listener's pings are only checked
+    against the pings that reached the same worker plus what the other workers already flushed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        # (last_ping, seconds_played) per row, including the pending deltas
+        self._state = {}
+        self._last_flush = time.time()
+        self._timer_pid = None
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'METRICS_BUFFER_FLUSH_INTERVAL', 5)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'METRICS_BUFFER_MAX_ENTRIES', 1000)
+
+    def add(self, validated_data, now=None):
+        """
+        Validates a ping like MetricView.passes_validation and buffers its deltas. Returns None if
+        the ping was rejected, otherwise the same dict as MetricsManager.upsert_ping.
+        """
+        now = now or timezone.now()
+        self._ensure_timer()
+        key = ping_key(validated_data, now)
+        stored = None
+        if key not in self._state:
+            stored = load_states([key])[key]
+
+        with self._lock:
+            result = check_ping(self._state.get(key, stored), validated_data, now)
+            if result is None:
+                return None
+            applied, self._state[key] = result
+            add_delta(self._pending, key, validated_data, applied, now)
+            should_flush = (len(self._pending) >= self.max_entries or
+                            time.time() - self._last_flush >= self.flush_interval)
+
+        if should_flush:
+            try:
+                self.flush()
+            except Exception:
+                # already logged, the deltas stay pending and the ping is buffered either way
+                pass
+        return applied
+
+    def flush(self):
+        """
+        Writes the pending deltas with one bulk upsert. If the write fails the deltas are merged
+        back so the next flush retries them.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+            # forget rows that went quiet, their next ping reloads what the other workers stored
+            now = timezone.now()
+            stale = [key for key, state in self._state.items()
+                     if key[4] < now.date() or state[0] + timedelta(hours=1) < now]
+            for key in stale:
+                del self._state[key]
+        if not pending:
+            return
+        try:
+            UserVideoMetric.objects.bulk_upsert_deltas(list(pending.values()))
+        except Exception:
+            logger.exception("Flushing {} buffered metrics failed".format(len(pending)))
+            with self._lock:
+                for key, metric in pending.items():
+                    current = self._pending.get(key)
+                    if current is not None:
+                        metric.seconds_played += current.seconds_played
+                        metric.play_count += current.play_count
+                        metric.last_ping = max(metric.last_ping, current.last_ping)
+                    self._pending[key] = metric
+            raise
+        bump_archive_versions(set(key[4] for key in pending))
+
+    def clear(self):
+        """
+        Drops the pending deltas and the known row states without writing them.
+        """
+        with self._lock:
+            self._pending = {}
+            self._state = {}
+
+    def _ensure_timer(self):
+        # started lazily and per process, so forking servers get a timer in every worker
+        pid = os.getpid()
+        if self._timer_pid == pid:
+            return
+        with self._lock:
+            if self._timer_pid == pid:
+                return
+            self._timer_pid = pid
+            thread = threading.Thread(target=self._run_timer, name='metrics-ping-buffer')
+            thread.daemon = True
+            thread.start()
+
+    def _run_timer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass  # already logged, the deltas stay pending
+
+
+ping_buffer = PingBuffer()
+
+
+@atexit.register
+def flush_ping_buffer():
+    ping_buffer.flush()
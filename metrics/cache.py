@@ -0,0 +1,98 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+
+from .periods import Period, add_months, today
+
+ARCHIVE_VERSION_KEY = 'metrics:archive:{year}-{month:02d}:version'
+ARCHIVE_SERIES_KEY = 'metrics:archive:{year}-{month:02d}:{version}:{granularity}'
+ARTIST_VERSION_KEY = 'metrics:artist:{artist_id}:version'
+
+
+def get_metrics_cache():
+    return caches[getattr(settings, 'METRICS_CACHE_ALIAS', DEFAULT_CACHE_ALIAS)]
+
+
+def _version(key):
+    # a missing version, never set or evicted, starts from the current time so it can't collide
+    # with anything derived from an earlier version
+    cache = get_metrics_cache()
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    cache = get_metrics_cache()
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), None)
+
+
+def archive_version(year, month):
+    """
+    The data version of a month.
+    """
+    return _version(ARCHIVE_VERSION_KEY.format(year=year, month=month))
+
+
+def artist_version(artist_id):
+    """
+    The version of an artist's events, bumped whenever ArtistEvent.objects.set_events changes them.
+    """
+    return _version(ARTIST_VERSION_KEY.format(artist_id=artist_id))
+
+
+def bump_artist_version(artist_id):
+    _bump_version(ARTIST_VERSION_KEY.format(artist_id=artist_id))
+
+
+def bump_archive_versions(days):
+    """
+    Invalidates the cached archive data of the closed months containing days. Pings can only land
+    in a closed month when they are written late by the ping buffer or the spool drain, the open
+    month isn't bumped since its entries expire after METRICS_ARCHIVE_CACHE_TIMEOUT anyway. Call
+    it once the pings are committed, so a concurrent read can't cache the old data again.
+    """
+    current = today()
+    for year, month in set((day.year, day.month) for day in days):
+        if (year, month) != (current.year, current.month):
+            _bump_version(ARCHIVE_VERSION_KEY.format(year=year, month=month))
+
+
+def bump_archive_months(first_day, last_day):
+    """
+    Like bump_archive_versions for every month from first_day's to last_day's, both included, for
+    rewrites of whole ranges like a rollup rebuild.
+    """
+    months = []
+    month = datetime.date(first_day.year, first_day.month, 1)
+    while month <= last_day:
+        months.append(month)
+        month = add_months(month, 1)
+    bump_archive_versions(months)
+
+
+def cached_archive_series(month, year, granularity, compute):
+    """
+    Returns compute() through the metrics cache, keyed by the month, its data version and the
+    granularity. Closed months are cached until their version is bumped, the current month for
+    METRICS_ARCHIVE_CACHE_TIMEOUT seconds.
+    """
+    cache = get_metrics_cache()
+    key = ARCHIVE_SERIES_KEY.format(
+        year=year, month=month, version=archive_version(year, month), granularity=granularity)
+    counts = cache.get(key)
+    if counts is None:
+        counts = compute()
+        if Period.month(year, month).is_closed():
+            timeout = None
+        else:
+            timeout = getattr(settings, 'METRICS_ARCHIVE_CACHE_TIMEOUT', 60)
+        cache.set(key, counts, timeout)
+    return counts
@@ -0,0 +1,102 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, Sum
+
+from .models import UserVideoMetric
+
+DIMENSIONS = ('date', 'event_id', 'recording_id', 'recording_type', 'user_id')
+DEFAULT_DIMENSIONS = ('date', 'event_id', 'recording_id')
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMATS = (CSV, NDJSON)
+CONTENT_TYPES = {CSV: 'text/csv', NDJSON: 'application/x-ndjson'}
+
+
+def export_rows(period, dimensions=DEFAULT_DIMENSIONS, event_ids=None, using=None, chunk_size=5000):
+    """
+    Yields the seconds_played and play_count of the period summed by dimensions, as dicts ordered
+    by the dimensions. The groups are fetched chunk_size at a time, each query resuming after the
+    last group of the previous one, and with date among the dimensions one day at a time, so the
+    memory used stays the same however long the period is. Read from the reporting queryset, which
+    covers the compacted days when rollups are on, unless user_id is a dimension.
+    """
+    metrics = UserVideoMetric.objects.db_manager(using)
+    if 'user_id' in dimensions:
+        qs = metrics.get_queryset().using(metrics.reporting_db)
+    else:
+        qs = metrics.get_reporting_queryset()
+    if event_ids is not None:
+        qs = qs.for_events(event_ids)
+    dimensions = list(dimensions)
+
+    if 'date' not in dimensions:
+        days = [period]
+    else:
+        days = period.buckets('day')
+    for day in days:
+        last = None
+        while True:
+            rows = day.filter(qs)
+            if last is not None:
+                rows = rows.filter(_after(dimensions, last))
+            rows = list(rows.values(*dimensions).order_by(*dimensions).annotate(
+                seconds_played=Sum('seconds_played'), play_count=Sum('play_count'))[:chunk_size])
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                break
+            last = [rows[-1][dimension] for dimension in dimensions]
+
+
+def _after(dimensions, values):
+    # the rows whose dimensions sort after values, Django can't compare them as one row value
+    after = Q()
+    for index, dimension in enumerate(dimensions):
+        equal = dict(zip(dimensions[:index], values[:index]))
+        after |= Q(**dict(equal, **{dimension + '__gt': values[index]}))
+    return after
+
+
+class Echo(object):
+    # the file csv.writer writes to, handing every line back instead of keeping it
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, dimensions=DEFAULT_DIMENSIONS):
+    fields = list(dimensions) + ['seconds_played', 'play_count']
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([row[field] for field in fields])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(period, dimensions=DEFAULT_DIMENSIONS, event_ids=None, output=CSV, using=None):
+    rows = export_rows(period, dimensions, event_ids, using)
+    if output == NDJSON:
+        return ndjson_lines(rows)
+    return csv_lines(rows, dimensions)
+
+
+def export_filename(period, output=CSV):
+    return "metrics-{0}-{1}.{2}".format(period.start, period.last_day, output)
+
+
+def parse_dimensions(values):
+    """
+    The dimensions in DIMENSIONS order, the default ones if values is empty. Raises ValueError
+    for an unknown dimension.
+    """
+    unknown = set(values) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError("Unknown dimensions {}".format(', '.join(sorted(unknown))))
+    if not values:
+        return DEFAULT_DIMENSIONS
+    return tuple(dimension for dimension in DIMENSIONS if dimension in values)
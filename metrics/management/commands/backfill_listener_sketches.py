@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from metrics.management.commands.rebuild_metric_rollups import parse_date
+from metrics.models import ListenerSketch
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the unique listener sketches from the raw metrics, one day per transaction. Run it before "
+            "setting METRICS_SKETCHES_ENABLED, and before compacting days whose sketches were never built. "
+            "Pings ingested for the rebuilt days while it runs can be missed, so run it when they are quiet.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=parse_date, help="First day to rebuild (YYYY-MM-DD)")
+        parser.add_argument('--end', type=parse_date, help="Day after the last one to rebuild (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        written = ListenerSketch.objects.backfill(options['start'], options['end'])
+        self.stdout.write("Wrote {} listener sketches".format(written))
@@ -0,0 +1,79 @@
+import json
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from metrics.benchmarks import report_calls, time_call, view_calls
+from metrics.models import DailyMetricRollup, UserVideoMetric, rollups_enabled
+from metrics.routers import primary_reads
+
+# time_call empties the metrics cache before every run, so the benchmark gets its own
+BENCHMARK_CACHE_ALIAS = 'metrics-benchmark'
+
+
+class Command(BaseCommand):
+    help = ("Times every MetricsManager report and report view on synthetic data of several sizes in a "
+            "throwaway test database and writes the results as JSON, to compare them across commits")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                            help="Numbers of metric rows to benchmark with")
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--events', type=int, default=1000)
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--video-share', type=float, default=0.5)
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per call, the fastest and median are kept")
+        parser.add_argument('--label', default='', help="Stored in the report, e.g. the commit benchmarked")
+        parser.add_argument('--output', help="File to write the JSON report to instead of stdout")
+
+    def handle(self, *args, **options):
+        report = {
+            'label': options['label'],
+            'created': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'rollups': rollups_enabled(),
+            'sizes': {},
+        }
+        caches = dict(settings.CACHES, **{BENCHMARK_CACHE_ALIAS: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': BENCHMARK_CACHE_ALIAS,
+        }})
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # the reports have to read the seeded test database, not METRICS_REPLICA_ALIAS
+            with override_settings(CACHES=caches, METRICS_CACHE_ALIAS=BENCHMARK_CACHE_ALIAS), primary_reads():
+                self.run_sizes(report, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run_sizes(self, report, options):
+        # never saved, the user model can be unmanaged and the report views only need it authenticated
+        user = get_user_model()(email='benchmark@example.com')
+        event_ids = list(range(1, options['events'] + 1))
+        recording_ids = [event_id * 2 for event_id in event_ids]
+        for size in options['sizes']:
+            UserVideoMetric.objects.all().delete()
+            DailyMetricRollup.objects.all().delete()
+            start = time.time()
+            UserVideoMetric.objects.create_random_bulk(
+                size, users=options['users'], events=options['events'], days=options['days'],
+                video_share=options['video_share'], seed=size)
+            results = {'generate_seconds': round(time.time() - start, 3), 'calls': {}}
+            calls = report_calls(event_ids, recording_ids) + view_calls(user, event_ids)
+            for name, call in calls:
+                results['calls'][name] = time_call(call, options['repeat'])
+            report['sizes'][str(size)] = results
+            self.stderr.write("{0} rows generated in {1}s".format(size, results['generate_seconds']))
@@ -0,0 +1,73 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIRequestFactory
+
+from metrics.authentication import CachedTokenAuthentication, token_cache
+from metrics.views import MetricView
+
+
+def create_user_table():
+    """
+    Creates the user model's table in the test database if migrate didn't, as it doesn't for an
+    unmanaged model like SmallsUser, whose table belongs to the main site.
+    """
+    user_model = get_user_model()
+    if user_model._meta.db_table not in connection.introspection.table_names():
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(user_model)
+
+
+class Command(BaseCommand):
+    help = ("Sends pings through MetricView in a throwaway test database, once with DRF's TokenAuthentication "
+            "and once with CachedTokenAuthentication, and reports the queries and time per ping")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pings', type=int, default=1000, help="Number of pings sent with each class")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            create_user_table()
+            user = get_user_model().objects.create(email='benchmark@example.com')
+            token = Token.objects.create(user=user)
+            token_cache.clear()
+            for index, authentication_class in enumerate((TokenAuthentication, CachedTokenAuthentication)):
+                # every pass creates its own rows, so no ping is rejected for coming too soon
+                recording_ids = range(index * options['pings'] + 1, (index + 1) * options['pings'] + 1)
+                self.benchmark(authentication_class, token, recording_ids)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def benchmark(self, authentication_class, token, recording_ids):
+        view = MetricView.as_view(authentication_classes=(authentication_class,))
+        factory = APIRequestFactory()
+        requests = []
+        for recording_id in recording_ids:
+            signed_data = signing.dumps({
+                'recording_id': recording_id, 'recording_type': 'A', 'event_id': 1, 'user_id': token.user_id,
+                'seconds_played': settings.PING_INTERVAL, 'play_count': 1,
+                'event_date': '2015-01-01T20:00:00',
+            })
+            requests.append(factory.post(
+                '/', {'signed_data': signed_data}, format='json', HTTP_REFERER=settings.SMALLSLIVE_SITE,
+                HTTP_AUTHORIZATION='Token {}'.format(token.key)))
+
+        start = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            for request in requests:
+                response = view(request)
+                if response.status_code != status.HTTP_201_CREATED:
+                    raise CommandError("MetricView answered a ping with {}".format(response.status_code))
+        elapsed = time.time() - start
+        self.stdout.write("{0}: {1:.2f} queries and {2:.2f} ms per ping".format(
+            authentication_class.__name__, len(queries) / float(len(requests)), elapsed * 1000 / len(requests)))
@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+
+from metrics.benchmarks import report_calls
+from metrics.models import DailyMetricRollup, LeaderboardEntry, ListenerSketch, UserVideoMetric
+from metrics.routers import primary_reads
+
+
+@contextmanager
+def recorded_queries():
+    """
+    Records the raw SQL and params of every query run on the default connection, so they can be
+    explained with the params bound by the driver.
+    """
+    queries = []
+
+    class RecordingCursorWrapper(CursorWrapper):
+        def execute(self, sql, params=None):
+            queries.append((sql, params))
+            return super(RecordingCursorWrapper, self).execute(sql, params)
+
+    connection.make_cursor = connection.make_debug_cursor = (
+        lambda cursor: RecordingCursorWrapper(cursor, connection))
+    try:
+        yield queries
+    finally:
+        del connection.make_cursor
+        del connection.make_debug_cursor
+
+
+def full_scans(sql, params):
+    """
+    Returns the plan lines of a query that scan a whole metrics table instead of an index.
+    """
+    tables = [model._meta.db_table for model in (UserVideoMetric, DailyMetricRollup, LeaderboardEntry, ListenerSketch)]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            lines = [row[-1] for row in cursor.fetchall()]
+            return [line for line in lines
+                    if line.startswith('SCAN') and 'INDEX' not in line and any(t in line for t in tables)]
+        cursor.execute('EXPLAIN ' + sql, params)
+        lines = [row[0] for row in cursor.fetchall()]
+        return [line.strip() for line in lines if 'Seq Scan on' in line and any(t in line for t in tables)]
+
+
+class Command(BaseCommand):
+    help = ("Seeds a throwaway test database, runs every MetricsManager report and fails if EXPLAIN shows "
+            "a filtered query scanning a whole metrics table. Queries without a WHERE clause, the all-time "
+            "totals, are expected to read everything and are skipped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help="Number of metric rows to seed")
+        parser.add_argument('--days', type=int, default=400, help="Number of days the rows are spread over")
+        parser.add_argument('--events', type=int, default=500, help="Number of events the rows belong to")
+
+    def handle(self, *args, **options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.seed(options['rows'], options['days'], options['events'])
+            failures = self.check_plans(range(1, options['events'] + 1))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        if failures:
+            raise CommandError("{} report queries scan a whole table".format(failures))
+        self.stdout.write("All filtered report queries use an index")
+
+    def seed(self, rows, days, events):
+        with primary_reads():
+            UserVideoMetric.objects.create_random_bulk(rows, users=max(rows // days, 1) * 4, events=events, days=days)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def check_plans(self, event_ids):
+        event_ids = list(event_ids)
+        recording_ids = [event_id * 2 for event_id in event_ids]
+        failures = 0
+        for name, call in report_calls(event_ids, recording_ids):
+            # the seeded test database is the primary, a replica would neither have the rows nor be recorded
+            with primary_reads(), recorded_queries() as queries:
+                call()
+            for sql, params in queries:
+                if not sql.lstrip().upper().startswith('SELECT') or ' WHERE ' not in sql:
+                    continue
+                scans = full_scans(sql, params)
+                if scans:
+                    failures += 1
+                    self.stdout.write("FAIL {0}: {1}\n  {2}".format(name, '; '.join(scans), sql))
+                else:
+                    self.stdout.write("ok   {0}".format(name))
+        return failures
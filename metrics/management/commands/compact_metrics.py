@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.models import UserVideoMetric
+from metrics.periods import Period
+
+
+class Command(BaseCommand):
+    help = ("Folds the per-user metrics older than --older-than days into the daily rollups and deletes them, "
+            "keeping the per-user rows of the events in METRICS_COMPACTION_KEEP_EVENT_IDS and --keep-event. "
+            "Needs METRICS_ROLLUP_ENABLED.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int,
+                            help="Compact the days before the last N days, today included")
+        parser.add_argument('--keep-event', type=int, action='append', default=[], dest='keep_event_ids',
+                            help="Keep the per-user rows of this event, can be repeated")
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help="Number of rows deleted per transaction")
+
+    def handle(self, *args, **options):
+        if options['older_than'] is None or options['older_than'] < 1:
+            raise CommandError("--older-than needs to be at least 1 day")
+        before = Period.rolling_days(options['older_than']).start
+        keep_event_ids = set(getattr(settings, 'METRICS_COMPACTION_KEEP_EVENT_IDS', ()))
+        keep_event_ids.update(options['keep_event_ids'])
+        try:
+            deleted = UserVideoMetric.objects.compact(before, keep_event_ids, options['chunk_size'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        self.stdout.write("Compacted {0} metrics from before {1}".format(deleted, before))
@@ -0,0 +1,33 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.models import PayoutSnapshot
+from metrics.periods import Period
+
+
+def parse_month(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise CommandError("Months need to be in YYYY-MM format, got {}".format(value))
+
+
+class Command(BaseCommand):
+    help = ("Stores every event's and artist's seconds_played, play_count and share of a closed month's "
+            "seconds_played as the month's payout snapshot. A month's snapshot can only be taken once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', type=parse_month, help="Month to snapshot (YYYY-MM)")
+
+    def handle(self, *args, **options):
+        if options['month'] is None:
+            raise CommandError("--month is required")
+        period = Period.month(options['month'].year, options['month'].month)
+        if not period.is_closed():
+            raise CommandError("{0.year}-{0.month:02d} isn't over yet".format(period.start))
+        if PayoutSnapshot.objects.filter(month=period.start).exists():
+            raise CommandError("{0.year}-{0.month:02d} already has a payout snapshot".format(period.start))
+        snapshot = PayoutSnapshot.objects.take(period.start.year, period.start.month)
+        self.stdout.write("Stored the shares of {0} events and {1} artists for {2.year}-{2.month:02d}".format(
+            snapshot.shares.count(), snapshot.artist_shares.count(), period.start))
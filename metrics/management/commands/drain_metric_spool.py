@@ -0,0 +1,26 @@
+import errno
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.spool import SpoolDrainer
+
+
+class Command(BaseCommand):
+    help = "Replays the pings spooled by MetricView into UserVideoMetric"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="Number of pings written per transaction")
+        parser.add_argument('--settle-seconds', type=int, default=5,
+                            help="Leave pings received in the last N seconds for the next run")
+
+    def handle(self, *args, **options):
+        drainer = SpoolDrainer(batch_size=options['batch_size'], settle_seconds=options['settle_seconds'])
+        try:
+            stats = drainer.drain()
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise CommandError("Another drain_metric_spool is already running")
+            raise
+        self.stdout.write("Drained {pings} pings ({applied} applied, {rejected} rejected, {invalid} invalid), "
+                          "removed {segments} segments".format(**stats))
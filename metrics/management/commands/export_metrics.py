@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.export import CSV, DIMENSIONS, FORMATS, export_lines, parse_dimensions
+from metrics.management.commands.rebuild_metric_rollups import parse_date
+from metrics.models import ArtistEvent
+from metrics.periods import Period
+
+
+class Command(BaseCommand):
+    help = ("Writes the seconds_played and play_count between two days summed by the chosen dimensions as CSV "
+            "or newline-delimited JSON, streaming them so any number of rows can be exported")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=parse_date, help="First day to export (YYYY-MM-DD)")
+        parser.add_argument('--end', type=parse_date, help="Last day to export (YYYY-MM-DD)")
+        parser.add_argument('--dimension', action='append', dest='dimensions', default=[],
+                            help="Sum by this field ({}), can be repeated. Defaults to date, event_id and "
+                                 "recording_id".format(', '.join(DIMENSIONS)))
+        parser.add_argument('--event', type=int, action='append', dest='event_ids',
+                            help="Only export this event, can be repeated")
+        parser.add_argument('--artist', type=int, help="Only export the events of this artist")
+        parser.add_argument('--format', choices=FORMATS, default=CSV)
+        parser.add_argument('--output', help="File to write to instead of stdout")
+
+    def handle(self, *args, **options):
+        if not options['start'] or not options['end'] or options['end'] < options['start']:
+            raise CommandError("--start and --end need to be given, --end not before --start")
+        try:
+            dimensions = parse_dimensions(options['dimensions'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        event_ids = options['event_ids']
+        if options['artist'] is not None:
+            event_ids = ArtistEvent.objects.event_ids(options['artist'])
+
+        lines = export_lines(Period.between(options['start'], options['end']), dimensions, event_ids,
+                             options['format'])
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,38 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.profiling import SNAPSHOT_SUFFIX, collect_stats
+
+
+class Command(BaseCommand):
+    help = ("Prints the call histograms the processes running with METRICS_PROFILING dumped to "
+            "METRICS_PROFILE_DIR, the most expensive calls first")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', default=False, help="Print the raw summaries as JSON")
+        parser.add_argument('--limit', type=int, default=30, help="Number of calls printed")
+        parser.add_argument('--reset', action='store_true', default=False, help="Delete the dumped histograms")
+
+    def handle(self, *args, **options):
+        profile_dir = getattr(settings, 'METRICS_PROFILE_DIR', None)
+        if not profile_dir:
+            raise CommandError("METRICS_PROFILE_DIR needs to be set to collect the profiles of other processes")
+        if options['reset']:
+            for name in os.listdir(profile_dir) if os.path.isdir(profile_dir) else ():
+                if name.endswith(SNAPSHOT_SUFFIX):
+                    os.remove(os.path.join(profile_dir, name))
+            return
+
+        stats = collect_stats()[:options['limit']]
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=2, sort_keys=True))
+            return
+        self.stdout.write("{0:<50} {1:>8} {2:>10} {3:>9} {4:>9} {5:>8} {6:>8}".format(
+            'call', 'calls', 'total ms', 'p50 ms', 'p95 ms', 'queries', 'rows'))
+        for summary in stats:
+            self.stdout.write("{0:<50} {1:>8} {2:>10.0f} {3:>9.1f} {4:>9.1f} {5:>8.1f} {6:>8.1f}".format(
+                summary['name'], summary['calls'], summary['time_ms']['total'], summary['time_ms']['p50'],
+                summary['time_ms']['p95'], summary['queries']['mean'], summary['rows']['mean']))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.models import LEADERBOARD_RANGES, LeaderboardEntry
+
+
+class Command(BaseCommand):
+    help = ("Recomputes the current most_popular leaderboards from the metrics and drops the ones of past "
+            "periods. Run it before setting METRICS_LEADERBOARDS_ENABLED, and to recover from drift.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--range', action='append', dest='range_sizes',
+                            help="Only rebuild this range ({}), can be repeated".format(', '.join(LEADERBOARD_RANGES)))
+
+    def handle(self, *args, **options):
+        range_sizes = options['range_sizes']
+        if range_sizes and not set(range_sizes) <= set(LEADERBOARD_RANGES):
+            raise CommandError("Ranges need to be in {}".format(', '.join(LEADERBOARD_RANGES)))
+        LeaderboardEntry.objects.rebuild(range_sizes)
+        self.stdout.write("Rebuilt {} leaderboard entries".format(LeaderboardEntry.objects.count()))
@@ -0,0 +1,37 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.models import DailyMetricRollup
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError("Dates need to be in YYYY-MM-DD format, got {}".format(value))
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the daily metric rollups from the raw metrics, or only compares them with --check. "
+            "Pings ingested for the rebuilt days while it runs can be lost, so run it when they are quiet.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=parse_date, help="First day to rebuild (YYYY-MM-DD)")
+        parser.add_argument('--end', type=parse_date, help="Day after the last one to rebuild (YYYY-MM-DD)")
+        parser.add_argument('--check', action='store_true', default=False,
+                            help="Only report the days where rollups and raw metrics differ")
+
+    def handle(self, *args, **options):
+        if options['check']:
+            mismatches = DailyMetricRollup.objects.mismatches(options['start'], options['end'])
+            for key, counts, raw_counts in mismatches:
+                self.stdout.write("{0} E{1} R{2} {3}: rollup {4}, raw {5}".format(
+                    key[0], key[1], key[2], key[3], counts, raw_counts))
+            if mismatches:
+                raise CommandError("{} rollups don't match the raw metrics".format(len(mismatches)))
+            self.stdout.write("Rollups match the raw metrics")
+            return
+
+        DailyMetricRollup.objects.rebuild(options['start'], options['end'])
+        self.stdout.write("Rebuilt {} rollups".format(DailyMetricRollup.objects.count()))
@@ -0,0 +1,30 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from metrics.models import ArtistEvent
+
+
+class Command(BaseCommand):
+    help = ("Syncs the artist events the artist reports look up by artist_id from a JSON object mapping every "
+            "artist id to the list of its event ids, read from a file or stdin")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help="JSON file to read, - for stdin (the default)")
+        parser.add_argument('--replace-all', action='store_true', default=False,
+                            help="Remove the events of the artists missing from the file")
+
+    def handle(self, *args, **options):
+        try:
+            if options['path'] == '-':
+                data = json.load(sys.stdin)
+            else:
+                with open(options['path']) as f:
+                    data = json.load(f)
+            mapping = dict((int(artist_id), [int(event_id) for event_id in event_ids])
+                           for artist_id, event_ids in data.items())
+        except (IOError, ValueError, TypeError, AttributeError) as e:
+            raise CommandError("Can't read the artist events: {}".format(e))
+        changed = ArtistEvent.objects.sync(mapping, options['replace_all'])
+        self.stdout.write("Synced {0} artists, {1} changed".format(len(mapping), len(changed)))
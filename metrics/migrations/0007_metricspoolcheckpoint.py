@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0006_uservideometric_event_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricSpoolCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('segment', models.CharField(unique=True, max_length=255)),
+                ('offset', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0007_metricspoolcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyMetricRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('event_id', models.PositiveIntegerField()),
+                ('recording_id', models.IntegerField()),
+                ('recording_type', models.CharField(max_length=1, choices=[('A', 'Audio'), ('V', 'Video')])),
+                ('seconds_played', models.BigIntegerField(default=0)),
+                ('play_count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailymetricrollup',
+            unique_together=set([('date', 'event_id', 'recording_id', 'recording_type')]),
+        ),
+    ]
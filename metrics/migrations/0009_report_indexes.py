@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0008_dailymetricrollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='uservideometric',
+            index_together=set([('event_id', 'date'), ('date', 'recording_type'), ('recording_id', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='dailymetricrollup',
+            index_together=set([('event_id', 'date'), ('recording_id', 'date')]),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0009_report_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricCompaction',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('compacted_before', models.DateField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
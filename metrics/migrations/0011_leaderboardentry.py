@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0010_metriccompaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('range_size', models.CharField(max_length=5)),
+                ('recording_type', models.CharField(max_length=1, blank=True)),
+                ('period_start', models.DateField()),
+                ('event_id', models.PositiveIntegerField()),
+                ('seconds_played', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='leaderboardentry',
+            unique_together=set([('range_size', 'recording_type', 'period_start', 'event_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='leaderboardentry',
+            index_together=set([('range_size', 'recording_type', 'period_start', 'seconds_played', 'event_id')]),
+        ),
+    ]
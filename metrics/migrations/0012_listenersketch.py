@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0011_leaderboardentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListenerSketch',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField()),
+                ('event_id', models.PositiveIntegerField()),
+                ('recording_type', models.CharField(max_length=1, choices=[('A', 'Audio'), ('V', 'Video')])),
+                ('sketch', models.BinaryField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='listenersketch',
+            unique_together=set([('date', 'event_id', 'recording_type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='listenersketch',
+            index_together=set([('event_id', 'date')]),
+        ),
+    ]
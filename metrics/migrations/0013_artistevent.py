@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0012_listenersketch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtistEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('artist_id', models.PositiveIntegerField()),
+                ('event_id', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='artistevent',
+            unique_together=set([('artist_id', 'event_id')]),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metrics', '0013_artistevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayoutSnapshot',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('month', models.DateField(unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('total_seconds_played', models.BigIntegerField()),
+                ('total_play_count', models.BigIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PayoutShare',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('event_id', models.PositiveIntegerField()),
+                ('seconds_played', models.BigIntegerField()),
+                ('play_count', models.BigIntegerField()),
+                ('share', models.FloatField(null=True)),
+                ('snapshot', models.ForeignKey(related_name='shares', to='metrics.PayoutSnapshot')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PayoutArtistShare',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('artist_id', models.PositiveIntegerField()),
+                ('seconds_played', models.BigIntegerField()),
+                ('play_count', models.BigIntegerField()),
+                ('share', models.FloatField(null=True)),
+                ('snapshot', models.ForeignKey(related_name='artist_shares', to='metrics.PayoutSnapshot')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='payoutshare',
+            unique_together=set([('snapshot', 'event_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='payoutartistshare',
+            unique_together=set([('snapshot', 'artist_id')]),
+        ),
+    ]
@@ -1,19 +1,157 @@
-import calendar
+import bisect
+import collections
+import copy
 import datetime
 import itertools
 import random
+from contextlib import contextmanager
 
-from django.db import models
-from django.db.models import Sum
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import Case, IntegerField, Max, Min, Q, Sum, Value, When
 from django.utils import timezone
 
+from .cache import bump_archive_months, bump_artist_version, cached_archive_series
+from .periods import DAY, Period, today
+from .profiling import profile_methods
+from .routers import primary_alias, reporting_alias
+from .sketches import HyperLogLog, seen_listeners
 from .utils import format_timespan
 
 RANGE_YEAR = 'year'
 RANGE_MONTH = 'month'
 RANGE_WEEK = 'week'
-
-
+RANGE_ALL_TIME = 'all'
+
+LEADERBOARD_RANGES = (RANGE_WEEK, RANGE_MONTH, RANGE_YEAR, RANGE_ALL_TIME)
+# period_start of the all-time leaderboards
+ALL_TIME_START = datetime.date(1970, 1, 1)
+
+SERIES_LISTS = (
+    'audio_plays_list', 'audio_minutes_list',
+    'video_plays_list', 'video_minutes_list',
+    'total_plays_list', 'total_minutes_list',
+)
+
+
+def rollups_enabled():
+    return getattr(settings, 'METRICS_ROLLUP_ENABLED', False)
+
+
+def leaderboards_enabled():
+    return getattr(settings, 'METRICS_LEADERBOARDS_ENABLED', False)
+
+
+def sketches_enabled():
+    return getattr(settings, 'METRICS_SKETCHES_ENABLED', False)
+
+
+def popular_range(weekly=False, range_size=None):
+    """
+    The range most_popular ranks the events over: range_size if it's a week, month or year,
+    otherwise all time, unless weekly is set without a range_size.
+    """
+    if range_size in (RANGE_WEEK, RANGE_MONTH, RANGE_YEAR):
+        return range_size
+    if weekly and not range_size:
+        return RANGE_WEEK
+    return RANGE_ALL_TIME
+
+
+def popular_cursor(entry):
+    """
+    The cursor to pass as after to most_popular to get the events ranked after entry.
+    """
+    return "{0}:{1}".format(entry['count'], entry['event_id'])
+
+
+def _parse_popular_cursor(cursor):
+    count, event_id = cursor.split(':')
+    return int(count), int(event_id)
+
+
+def _upsert_connection(using):
+    connection = connections[using]
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        raise ImproperlyConfigured("Upserting metrics needs PostgreSQL or SQLite, not {}".format(
+            connection.vendor))
+    return connection
+
+
+def _upsert_sql(connection, model, objs, conflict_fields, update_sql):
+    """
+    Builds a multi-row INSERT ... ON CONFLICT DO UPDATE statement for the unsaved model instances,
+    with update_sql as the DO UPDATE clause, or DO NOTHING if it's None. {table} and the field
+    names in update_sql are replaced with their quoted table and column names. Returns the
+    statement and its params.
+    """
+    opts = model._meta
+    fields = [field for field in opts.concrete_fields if not field.primary_key]
+    qn = connection.ops.quote_name
+    columns = dict((field.name, qn(field.column)) for field in opts.concrete_fields)
+    row_sql = "({})".format(", ".join(["%s"] * len(fields)))
+    sql = "INSERT INTO {table} ({columns}) VALUES {rows} ON CONFLICT ({conflict}) ".format(
+        table=qn(opts.db_table),
+        columns=", ".join(qn(field.column) for field in fields),
+        rows=", ".join([row_sql] * len(objs)),
+        conflict=", ".join(columns[name] for name in conflict_fields),
+    )
+    if update_sql is None:
+        sql += "DO NOTHING"
+    else:
+        sql += "DO UPDATE SET " + update_sql.format(table=qn(opts.db_table), **columns)
+    params = [
+        field.get_db_prep_save(getattr(obj, field.attname), connection)
+        for obj in objs for field in fields
+    ]
+    return sql, params
+
+
+def _bulk_upsert(using, model, objs, conflict_fields, update_sql):
+    connection = _upsert_connection(using)
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+    with connection.cursor() as cursor:
+        for start in range(0, len(objs), batch_size):
+            sql, params = _upsert_sql(connection, model, objs[start:start + batch_size], conflict_fields, update_sql)
+            cursor.execute(sql, params)
+
+
+@contextmanager
+def ingestion_atomic(using=None, savepoint=True):
+    """
+    transaction.atomic for the blocks adding pings. Django 1.8 has no on_commit hook, so the
+    listeners ListenerSketchManager.add_listeners adds inside it are only marked as seen once the
+    transaction commits. After a rollback their next ping updates the sketches again.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    mark = seen_listeners.begin(using)
+    succeeded = False
+    try:
+        with transaction.atomic(using=using, savepoint=savepoint):
+            yield
+        succeeded = True
+    finally:
+        committed = succeeded and not transaction.get_connection(using).in_atomic_block
+        seen_listeners.end(using, mark, succeeded, committed)
+
+
+def reserved_last_ping():
+    # older than any real ping, it marks the rows MetricsManager.reserve_rows inserted
+    reserved = datetime.datetime.combine(ALL_TIME_START, datetime.time())
+    return timezone.make_aware(reserved, timezone.utc) if settings.USE_TZ else reserved
+
+
+def _uncompacted_range(using, start_date, end_date):
+    horizon = MetricCompaction.objects.db_manager(using).horizon()
+    if horizon and (start_date is None or start_date < horizon):
+        # the raw metrics of these days are gone, only their rollups and sketches are left
+        start_date = horizon
+    return start_date, end_date
+
+
+@profile_methods(exclude=('audio', 'video', 'for_events', 'total_counts_annotate'))
 class MetricsQuerySet(models.QuerySet):
     def audio(self):
         return self.filter(recording_type='A')
@@ -21,6 +159,20 @@ class MetricsQuerySet(models.QuerySet):
     def video(self):
         return self.filter(recording_type='V')
 
+    def for_events(self, event_ids):
+        """
+        Filters on a list of event ids, or on a queryset of them such as
+        ArtistEvent.objects.event_ids(artist_id), which is sent as a subquery instead of an IN
+        list. An empty list doesn't filter.
+        """
+        if isinstance(event_ids, models.QuerySet):
+            return self.filter(event_id__in=event_ids.using(self.db))
+        if not event_ids:
+            return self
+        if len(event_ids) == 1:
+            return self.filter(event_id=event_ids[0])
+        return self.filter(event_id__in=event_ids)
+
     def video_counts(self):
         counts = self.filter(recording_type='V').aggregate(seconds_played=Sum('seconds_played'), play_count=Sum('play_count'))
         counts['seconds_played'] = counts['seconds_played'] or 0
@@ -42,78 +194,108 @@ class MetricsQuerySet(models.QuerySet):
     def total_counts_annotate(self):
         return self.annotate(seconds_played=Sum('seconds_played'), play_count=Sum('play_count'))
 
-    def most_popular_audio(self, weekly=False, range_size=None):
-        return self.audio().most_popular(weekly=weekly, range_size=range_size)
-
-    def most_popular_video(self, weekly=False, range_size=None):
-        return self.video().most_popular(weekly=weekly, range_size=range_size)
-
-    def most_popular(self, weekly=False, range_size=None):
-        qs = self
+    def period_counts(self, **periods):
+        """
+        Returns the total counts of several periods from a single pass over the table, each period
+        given as a Q object (or None for the whole queryset) whose rows are summed conditionally.
+        """
+        result = self.aggregate(**self._period_aggregates(periods))
+        return self._unpack_period_counts(result, periods)
 
-        range_start = None
-        range_end = None
-        if range_size:
-            if range_size == RANGE_WEEK:
-                range_end, range_start = self.get_weekly_range()
-            elif range_size == RANGE_MONTH:
-                range_end, range_start = self.get_monthly_range()
-            elif range_size == RANGE_YEAR:
-                range_end, range_start = self.get_year_range()
+    def grouped_period_counts(self, group_field, **periods):
+        """
+        Like period_counts, but grouped by group_field (e.g. event_id) in a single query. Returns
+        a dict of the period counts keyed by the group_field values.
+        """
+        rows = self.values(group_field).order_by().annotate(**self._period_aggregates(periods))
+        return dict((row[group_field], self._unpack_period_counts(row, periods)) for row in rows)
+
+    def _period_aggregates(self, periods):
+        aggregates = {}
+        for name, condition in periods.items():
+            for field in ('seconds_played', 'play_count'):
+                if condition is None:
+                    aggregate = Sum(field)
+                else:
+                    aggregate = Sum(Case(When(condition, then=field), default=Value(0), output_field=IntegerField()))
+                aggregates['{0}_{1}'.format(name, field)] = aggregate
+        return aggregates
+
+    def _unpack_period_counts(self, result, periods):
+        return dict(
+            (name, {
+                'seconds_played': result['{0}_seconds_played'.format(name)] or 0,
+                'play_count': result['{0}_play_count'.format(name)] or 0,
+            })
+            for name in periods
+        )
 
-        else:
-            if weekly:
-                range_end, range_start = self.get_weekly_range()
+    def most_popular_audio(self, weekly=False, range_size=None, after=None):
+        return self.audio().most_popular(weekly=weekly, range_size=range_size, after=after)
 
-        if range_start and range_end:
-            qs = qs.filter(date__range=(range_start, range_end))
+    def most_popular_video(self, weekly=False, range_size=None, after=None):
+        return self.video().most_popular(weekly=weekly, range_size=range_size, after=after)
 
-        return qs.values('event_id').annotate(
+    def most_popular(self, weekly=False, range_size=None, after=None):
+        """
+        The events by seconds_played in the range of popular_range, or after the popular_cursor
+        of an event.
+        """
+        range_size = popular_range(weekly, range_size)
+        qs = self
+        if range_size != RANGE_ALL_TIME:
+            qs = Period.containing(range_size).filter(qs)
+        qs = qs.values('event_id').annotate(
             count=Sum('seconds_played')
-        ).order_by('-count')
+        )
+        if after:
+            count, event_id = _parse_popular_cursor(after)
+            qs = qs.filter(Q(count__lt=count) | Q(count=count, event_id__lt=event_id))
+        return qs.order_by('-count', '-event_id')
 
     def get_weekly_range(self):
-        now = timezone.now()
-        range_start = (now - datetime.timedelta(days=now.weekday())).date()
-        range_end = range_start + datetime.timedelta(weeks=1)
-        return range_end, range_start
+        period = Period.week()
+        return period.last_day, period.start
 
     def get_monthly_range(self):
-        now = timezone.now()
-        current_year = now.year
-        current_month = now.month
-
-        range_start = datetime.date(current_year, current_month, 1)
-        range_end = datetime.date(
-            current_year, current_month, calendar.monthrange(
-                current_year, current_month
-            )[1]
-        )
-
-        return range_end, range_start
+        period = Period.month()
+        return period.last_day, period.start
 
     def get_year_range(self):
-        now = timezone.now()
-        current_year = now.year
-
-        range_start = datetime.date(current_year, 1, 1)
-        range_end = datetime.date(current_year, 12, 31)
-
-        return range_end, range_start
+        period = Period.year()
+        return period.last_day, period.start
 
 
+@profile_methods(exclude=('get_queryset', 'get_reporting_queryset'))
 class MetricsManager(models.Manager):
     def get_queryset(self):
         return MetricsQuerySet(self.model, using=self._db)
 
+    @property
+    def reporting_db(self):
+        """
+        The database the reports read from: the one picked with db_manager(), otherwise
+        metrics.routers.reporting_alias(), the read replica if one is configured.
+        """
+        return self._db or reporting_alias()
+
+    def get_reporting_queryset(self):
+        """
+        The queryset reports aggregate over, the daily rollup when METRICS_ROLLUP_ENABLED is set.
+        Both share MetricsQuerySet and the date/event/recording columns the reports filter on.
+        """
+        if rollups_enabled():
+            return DailyMetricRollup.objects.using(self.reporting_db).all()
+        return self.get_queryset().using(self.reporting_db)
+
     def counts_for_artist(self, artist_recording_ids, humanize=False):
-        counts = self.get_queryset().filter(recording_id__in=artist_recording_ids).total_counts()
+        counts = self.get_reporting_queryset().filter(recording_id__in=artist_recording_ids).total_counts()
         if humanize:
             counts['time_played'] = format_timespan(counts['seconds_played'])
         return counts
 
     def seconds_played_for_all_events(self, start_date, end_date):
-        qs = self.get_queryset().filter(date__range=(start_date, end_date)).values(
+        qs = Period.between(start_date, end_date).filter(self.get_reporting_queryset()).values(
             'event_id').annotate(seconds_played=Sum('seconds_played'))
         return qs
 
@@ -125,115 +307,80 @@ class MetricsManager(models.Manager):
             percentage = None
         return percentage
 
-    def _calculate_week_trends(self, counts, week_start, week_end, recording_type=None, event_ids=None, recording_id=None):
-        last_week_start = week_start - datetime.timedelta(weeks=1)
-        last_week_end = week_end - datetime.timedelta(weeks=1)
-        qs = self.get_queryset().filter(date__range=(last_week_start, last_week_end))
-        if event_ids:
-            if len(event_ids) > 1:
-                qs = qs.filter(event_id__in=event_ids)
-            else:
-                qs = qs.filter(event_id=event_ids[0])
+    def _calculate_trends(self, counts, period, recording_type=None, event_ids=None, recording_id=None):
+        qs = period.previous().filter(self.get_reporting_queryset())
+        if event_ids is not None:
+            qs = qs.for_events(event_ids)
         elif recording_id:
             qs = qs.filter(recording_id=recording_id)
 
         if recording_type == "audio":
-            last_week_counts = qs.audio_counts()
-        elif recording_type == "video":
-            last_week_counts = qs.video_counts()
-        else:
-            last_week_counts = qs.total_counts()
-        this_week_seconds = int(counts['seconds_played'])
-        last_week_seconds = int(last_week_counts['seconds_played'])
-        if last_week_seconds != 0:
-            counts['seconds_played_trend'] = ((this_week_seconds - last_week_seconds) / float(last_week_seconds)) * 100
-        else:
-            counts['seconds_played_trend'] = None
-
-        this_week_plays = counts['play_count']
-        last_week_plays = last_week_counts['play_count']
-        if last_week_plays != 0:
-            counts['play_count_trend'] = ((this_week_plays - last_week_plays) / float(last_week_plays)) * 100
-        else:
-            counts['play_count_trend'] = None
-        return counts
-
-    def _calculate_month_trends(self, counts, month, year, recording_type=None, event_ids=None, recording_id=None):
-        this_month = datetime.date(year, month, 1)
-        last_month = this_month - datetime.timedelta(days=1)
-        qs = self.get_queryset().filter(date__month=last_month.month, date__year=last_month.year)
-        if event_ids:
-            if len(event_ids) > 1:
-                qs = qs.filter(event_id__in=event_ids)
-            else:
-                qs = qs.filter(event_id=event_ids[0])
-        elif recording_id:
-            qs = qs.filter(recording_id=recording_id)
-            
-        if recording_type == "audio":
-            last_month_counts = qs.audio_counts()
+            previous_counts = qs.audio_counts()
         elif recording_type == "video":
-            last_month_counts = qs.video_counts()
+            previous_counts = qs.video_counts()
         else:
-            last_month_counts = qs.total_counts()
-        this_month_seconds = counts['seconds_played']
-        last_month_seconds = last_month_counts['seconds_played']
-        if last_month_seconds != 0:
-            counts['seconds_played_trend'] = ((this_month_seconds - last_month_seconds) / float(last_month_seconds)) * 100
+            previous_counts = qs.total_counts()
+        return self._add_trends(counts, previous_counts)
+
+    def _add_trends(self, counts, previous_counts):
+        this_seconds = int(counts['seconds_played'])
+        previous_seconds = int(previous_counts['seconds_played'])
+        if previous_seconds != 0:
+            counts['seconds_played_trend'] = ((this_seconds - previous_seconds) / float(previous_seconds)) * 100
         else:
             counts['seconds_played_trend'] = None
 
-        this_month_plays = counts['play_count']
-        last_month_plays = last_month_counts['play_count']
-        if last_month_plays != 0:
-            counts['play_count_trend'] = ((this_month_plays - last_month_plays) / float(last_month_plays)) * 100
+        this_plays = counts['play_count']
+        previous_plays = previous_counts['play_count']
+        if previous_plays != 0:
+            counts['play_count_trend'] = ((this_plays - previous_plays) / float(previous_plays)) * 100
         else:
             counts['play_count_trend'] = None
         return counts
 
     def counts_for_event(self, event_id, humanize=False):
-        now = timezone.now()
-        week_start = (now - datetime.timedelta(days=now.weekday())).date()
-        week_end = week_start + datetime.timedelta(weeks=1)
-        this_week_counts = self.get_queryset().filter(
-            date__range=(week_start, week_end), event_id=event_id).total_counts()
-        this_month_counts = self.get_queryset().filter(
-            date__month=now.month, date__year=now.year, event_id=event_id).total_counts()
-        all_time_counts = self.get_queryset().filter(event_id=event_id).total_counts()
+        return self.counts_for_events([event_id], humanize)[int(event_id)]
 
+    def counts_for_events(self, event_ids, humanize=False):
+        """
+        The week, month and all-time counts of every event, with their share of the archive
+        totals, keyed by event id. One grouped query covers all the events and the archive totals
+        are computed once, so the number of queries doesn't grow with the number of events. The
+        ids are taken as ints, like the event_id column the counts are grouped by.
+        """
+        event_ids = [int(event_id) for event_id in event_ids]
+        if not event_ids:
+            return {}
+        periods = {'week': Period.week(), 'month': Period.month(), 'all_time': None}
+        grouped = self.get_reporting_queryset().for_events(event_ids).grouped_period_counts(
+            'event_id', **dict((name, period and period.q()) for name, period in periods.items()))
         total_archive_counts = self.total_archive_counts()
-        this_week_counts['play_count_percentage'] = self._calculate_percentage(this_week_counts['play_count'],
-                                                                               total_archive_counts['week'][
-                                                                                   'play_count'])
-        this_week_counts['seconds_played_percentage'] = self._calculate_percentage(this_week_counts['seconds_played'],
-                                                                                   total_archive_counts['week'][
-                                                                                       'seconds_played'])
-        this_month_counts['play_count_percentage'] = self._calculate_percentage(this_month_counts['play_count'],
-                                                                                total_archive_counts['month'][
-                                                                                    'play_count'])
-        this_month_counts['seconds_played_percentage'] = self._calculate_percentage(this_month_counts['seconds_played'],
-                                                                                    total_archive_counts['month'][
-                                                                                        'seconds_played'])
-        all_time_counts['play_count_percentage'] = self._calculate_percentage(all_time_counts['play_count'],
-                                                                              total_archive_counts['all_time'][
-                                                                                  'play_count'])
-        all_time_counts['seconds_played_percentage'] = self._calculate_percentage(all_time_counts['seconds_played'],
-                                                                                  total_archive_counts['all_time'][
-                                                                                      'seconds_played'])
+        listeners = None
+        if sketches_enabled():
+            listeners = ListenerSketch.objects.db_manager(self.reporting_db).event_period_listeners(
+                event_ids, **periods)
 
-        if humanize:
-            this_week_counts['time_played'] = format_timespan(this_week_counts['seconds_played'])
-            this_month_counts['time_played'] = format_timespan(this_month_counts['seconds_played'])
-            all_time_counts['time_played'] = format_timespan(all_time_counts['seconds_played'])
-        counts = {
-            'week': this_week_counts,
-            'month': this_month_counts,
-            'all_time': all_time_counts
-        }
+        empty = {'seconds_played': 0, 'play_count': 0}
+        counts = {}
+        for event_id in event_ids:
+            event_counts = {}
+            for name in periods:
+                period_counts = dict(grouped.get(event_id, {}).get(name, empty))
+                archive_counts = total_archive_counts[name]
+                period_counts['play_count_percentage'] = self._calculate_percentage(
+                    period_counts['play_count'], archive_counts['play_count'])
+                period_counts['seconds_played_percentage'] = self._calculate_percentage(
+                    period_counts['seconds_played'], archive_counts['seconds_played'])
+                if listeners is not None:
+                    period_counts['unique_listeners'] = listeners[event_id][name]
+                if humanize:
+                    period_counts['time_played'] = format_timespan(period_counts['seconds_played'])
+                event_counts[name] = period_counts
+            counts[event_id] = event_counts
         return counts
 
     def all_time_for_artist(self, artist_event_ids, humanize=False):
-        all_time_counts = self.get_queryset().filter(event_id__in=artist_event_ids).total_counts()
+        all_time_counts = self.get_reporting_queryset().filter(event_id__in=artist_event_ids).total_counts()
         total_archive_counts = self.total_archive_counts()
         all_time_counts['play_count_percentage'] = self._calculate_percentage(all_time_counts['play_count'],
                                                                               total_archive_counts['all_time'][
@@ -241,22 +388,23 @@ class MetricsManager(models.Manager):
         all_time_counts['seconds_played_percentage'] = self._calculate_percentage(all_time_counts['seconds_played'],
                                                                                   total_archive_counts['all_time'][
                                                                                       'seconds_played'])
+        if sketches_enabled():
+            all_time_counts['unique_listeners'] = ListenerSketch.objects.db_manager(
+                self.reporting_db).period_listeners(artist_event_ids, all_time=None)['all_time']
         if humanize:
             all_time_counts['time_played'] = format_timespan(all_time_counts['seconds_played'])
 
         return all_time_counts
 
     def counts_for_recording(self, recording_id, trends=False, humanize=False):
-        now = timezone.now()
-        week_start = (now - datetime.timedelta(days=now.weekday())).date()
-        week_end = week_start + datetime.timedelta(weeks=1)
-        this_week_counts = self.get_queryset().filter(
-            date__range=(week_start, week_end), recording_id=recording_id).total_counts()
+        week = Period.week()
+        this_week_counts = week.filter(self.get_reporting_queryset()).filter(
+            recording_id=recording_id).total_counts()
 
         if trends:
-            this_week_counts = self._calculate_week_trends(this_week_counts, week_start, week_end, recording_id=recording_id)
+            this_week_counts = self._calculate_trends(this_week_counts, week, recording_id=recording_id)
 
-        all_time_counts = self.get_queryset().filter(recording_id=recording_id).total_counts()
+        all_time_counts = self.get_reporting_queryset().filter(recording_id=recording_id).total_counts()
 
         if humanize:
             this_week_counts['time_played'] = format_timespan(this_week_counts['seconds_played'])
@@ -268,58 +416,47 @@ class MetricsManager(models.Manager):
         return counts
 
     def total_archive_counts(self, trends=False, recording_type=None, humanize=False):
-        now = timezone.now()
-        week_start = (now - datetime.timedelta(days=6)).date()
-        week_end = now
-        this_week_qs = self.get_queryset().filter(date__range=(week_start, week_end))
-        this_month_qs = self.get_queryset().filter(date__month=now.month, date__year=now.year)
-        all_time_qs = self.get_queryset()
+        week = Period.week()
+        month = Period.month()
+        periods = {
+            'week': week.q(),
+            'month': month.q(),
+            'all_time': None,
+        }
+        if trends:
+            periods['last_week'] = week.previous().q()
+            periods['last_month'] = month.previous().q()
 
+        qs = self.get_reporting_queryset()
         if recording_type == 'audio':
-            this_week_counts = this_week_qs.audio_counts()
-            this_month_counts = this_month_qs.audio_counts()
-            all_time_counts = all_time_qs.audio_counts()
+            qs = qs.audio()
         elif recording_type == 'video':
-            this_week_counts = this_week_qs.video_counts()
-            this_month_counts = this_month_qs.video_counts()
-            all_time_counts = all_time_qs.video_counts()
-        else:
-            this_week_counts = this_week_qs.total_counts()
-            this_month_counts = this_month_qs.total_counts()
-            all_time_counts = all_time_qs.total_counts()
+            qs = qs.video()
+        counts = qs.period_counts(**periods)
 
         if trends:
-            this_week_counts = self._calculate_week_trends(this_week_counts, week_start, week_end, recording_type=recording_type)
-            this_month_counts = self._calculate_month_trends(this_month_counts, now.month, now.year, recording_type=recording_type)
+            self._add_trends(counts['week'], counts.pop('last_week'))
+            self._add_trends(counts['month'], counts.pop('last_month'))
 
         if humanize:
-            this_week_counts['time_played'] = format_timespan(this_week_counts['seconds_played'])
-            this_month_counts['time_played'] = format_timespan(this_month_counts['seconds_played'])
-            all_time_counts['time_played'] = format_timespan(all_time_counts['seconds_played'])
-        counts = {
-            'week': this_week_counts,
-            'month': this_month_counts,
-            'all_time': all_time_counts
-        }
+            for period_counts in counts.values():
+                period_counts['time_played'] = format_timespan(period_counts['seconds_played'])
         return counts
 
     def this_month_total_archive(self, humanize=False):
-        now = timezone.now().date()
-        counts = self.get_queryset().filter(date__month=now.month, date__year=now.year).total_counts()
+        counts = Period.month().filter(self.get_reporting_queryset()).total_counts()
         if humanize:
             counts['time_played'] = format_timespan(counts['seconds_played'])
-        return
+        return counts
 
     def this_week_counts(self, artist_event_ids=None, trends=False, humanize=False):
-        now = timezone.now()
-        week_start = (now - datetime.timedelta(days=now.weekday())).date()
-        week_end = week_start + datetime.timedelta(weeks=1)
-        qs = self.get_queryset().filter(date__range=(week_start, week_end))
+        week = Period.week()
+        qs = week.filter(self.get_reporting_queryset())
         # needed because sometimes an empty list is passed
         if artist_event_ids is not None:
             counts = qs.filter(event_id__in=artist_event_ids).total_counts()
             if trends:
-                counts = self._calculate_week_trends(counts, week_start, week_end, event_ids=artist_event_ids)
+                counts = self._calculate_trends(counts, week, event_ids=artist_event_ids)
         else:
             counts = qs.total_counts()
         if humanize:
@@ -327,12 +464,13 @@ class MetricsManager(models.Manager):
         return counts
 
     def monthly_counts(self, month, year, artist_event_ids=None, trends=False, humanize=False):
-        qs = self.get_queryset().filter(date__month=month, date__year=year)
+        period = Period.month(year, month)
+        qs = period.filter(self.get_reporting_queryset())
         # needed because sometimes an empty list is passed
         if artist_event_ids is not None:
             counts = qs.filter(event_id__in=artist_event_ids).total_counts()
             if trends:
-                counts = self._calculate_month_trends(counts, month, year, event_ids=artist_event_ids)
+                counts = self._calculate_trends(counts, period, event_ids=artist_event_ids)
         else:
             counts = qs.total_counts()
         if humanize:
@@ -340,74 +478,126 @@ class MetricsManager(models.Manager):
         return counts
 
     def this_month_counts(self, artist_event_ids=None, trends=False, humanize=False):
-        now = timezone.now()
+        now = today()
         return self.monthly_counts(now.month, now.year, artist_event_ids=artist_event_ids,
                                    trends=trends, humanize=humanize)
 
     def this_month_counts_for_artist(self, artist_event_ids, trends=False, humanize=False):
-        now = timezone.now()
+        now = today()
         return self.monthly_counts(now.month, now.year, artist_event_ids=artist_event_ids,
                                    trends=trends, humanize=humanize)
 
-    def date_counts(self, month, year, artist_event_ids=None):
+    def date_counts(self, month, year, artist_event_ids=None, granularity=DAY):
         """
         Returns a list of play counts and seconds played per day. If the requested month is the current
         month, return values only up to the current day (don't add zeroes for remaining months)
         """
-        qs = self.get_queryset().filter(date__month=month, date__year=year)
-        if artist_event_ids:
-            if len(artist_event_ids) == 1:
-                qs = qs.filter(event_id=artist_event_ids[0])
-            else:
-                qs = qs.filter(event_id__in=artist_event_ids)
+        period = Period.month(year, month)
+        now = today()
+        last_day = now if now in period else period.last_day
+        counts = self.date_series(period.start, last_day, granularity, artist_event_ids)
+        counts['dates'] = ["{0}/{1}".format(month, day.day) for day in counts['dates']]
+        return counts
 
-        qs = qs.values('date', 'recording_type').order_by('date').total_counts_annotate()
+    def archive_date_counts(self, month, year, granularity=DAY):
+        """
+        date_counts for the whole archive, which is the same for every artist dashboard, through the
+        metrics cache. Closed months stay cached until late pings bump their version, so they're
+        computed on the primary, where those pings are already committed, not on the replica.
+        """
+        metrics = self
+        if not self._db and Period.month(year, month).is_closed():
+            metrics = self.db_manager(primary_alias())
+        return cached_archive_series(month, year, granularity, lambda: metrics.date_counts(
+            month, year, granularity=granularity))
 
-        now = timezone.now().date()
-        if now.month == month and now.year == year:
-            days_in_month = now.day
-        else:
-            days_in_month = calendar.monthrange(year, month)[1]
-        days = range(1, days_in_month+1)
-        audio_play_counts = {}
-        audio_minutes_counts = {}
-        video_play_counts = {}
-        video_minutes_counts = {}
-        for entry in qs:
-            day = entry['date'].day
-            if entry['recording_type'] == 'V':
-                video_play_counts[day] = entry['play_count']
-                video_minutes_counts[day] = entry['seconds_played'] / 60
-            else:
-                audio_play_counts[day] = entry['play_count']
-                audio_minutes_counts[day] = entry['seconds_played'] / 60
-        counts = {}
-        counts['audio_plays_list'] = [audio_play_counts.get(day_number, 0) for day_number in days]
-        counts['audio_minutes_list'] = [audio_minutes_counts.get(day_number, 0) for day_number in days]
-        counts['video_plays_list'] = [video_play_counts.get(day_number, 0) for day_number in days]
-        counts['video_minutes_list'] = [video_minutes_counts.get(day_number, 0) for day_number in days]
-        counts['total_plays_list'] = [a+v for a, v in zip(counts['audio_plays_list'], counts['video_plays_list'])]
-        counts['total_minutes_list'] = [a+v for a, v in zip(counts['audio_minutes_list'], counts['video_minutes_list'])]
-        counts['dates'] = ["{0}/{1}".format(month, day) for day in days]
+    def date_series(self, start_date, end_date, granularity=DAY, artist_event_ids=None):
+        """
+        Returns the audio, video and total plays and minutes per day, ISO week or month between
+        start_date and end_date (both included) as lists, with zeroes for the buckets without plays.
+        The rows are grouped by day in one query and folded into the buckets in a single pass, the
+        first and last buckets being cut to the range. 'dates' holds the first day of each bucket.
+        """
+        period = Period.between(start_date, end_date)
+        buckets = period.buckets(granularity)
+        qs = period.filter(self.get_reporting_queryset()).for_events(artist_event_ids)
+        rows = iter(qs.values('date', 'recording_type').order_by('date').total_counts_annotate())
+
+        counts = dict((name, []) for name in SERIES_LISTS)
+        row = next(rows, None)
+        for bucket in buckets:
+            totals = {'A': [0, 0], 'V': [0, 0]}
+            while row is not None and row['date'] < bucket.end:
+                bucket_totals = totals['V' if row['recording_type'] == 'V' else 'A']
+                bucket_totals[0] += row['play_count']
+                bucket_totals[1] += row['seconds_played']
+                row = next(rows, None)
+            counts['audio_plays_list'].append(totals['A'][0])
+            counts['audio_minutes_list'].append(totals['A'][1] // 60)
+            counts['video_plays_list'].append(totals['V'][0])
+            counts['video_minutes_list'].append(totals['V'][1] // 60)
+            counts['total_plays_list'].append(totals['A'][0] + totals['V'][0])
+            counts['total_minutes_list'].append(totals['A'][1] // 60 + totals['V'][1] // 60)
+        counts['dates'] = [bucket.start for bucket in buckets]
         return counts
 
-    def top_week_events(self, artist_event_ids=None, trends=False):
-        now = timezone.now()
-        week_start = (now - datetime.timedelta(days=now.weekday())).date()
-        week_end = week_start + datetime.timedelta(weeks=1)
-        qs = self.get_queryset().filter(date__range=(week_start, week_end))
-        if artist_event_ids:
-            qs = qs.filter(event_id__in=artist_event_ids)
-        counts = list(qs.values('event_id').total_counts_annotate().order_by('-seconds_played')[:10])
-        if trends:
-            for idx, count in enumerate(counts):
-                counts[idx] = self._calculate_week_trends(count, week_start, week_end, event_ids=[count['event_id']])
+    def top_week_events(self, artist_event_ids=None, trends=False, limit=10):
+        qs = Period.week().filter(self.get_reporting_queryset()).for_events(artist_event_ids)
+        counts = list(qs.values('event_id').total_counts_annotate().order_by('-seconds_played')[:limit])
+        if trends and counts:
+            week_trends = self.week_trends(event_ids=[count['event_id'] for count in counts])
+            for count in counts:
+                trend = week_trends[count['event_id']]
+                count['seconds_played_trend'] = trend['seconds_played_trend']
+                count['play_count_trend'] = trend['play_count_trend']
         return counts
 
+    def week_trends(self, event_ids=None, recording_ids=None):
+        """
+        This week's and last week's counts with trend percentages for every event (or recording)
+        in the list, from one grouped query.
+        """
+        return self.period_trends(Period.week(), event_ids=event_ids, recording_ids=recording_ids)
+
+    def month_trends(self, month, year, event_ids=None, recording_ids=None):
+        """
+        The month's and the previous month's counts with trend percentages for every event (or
+        recording) in the list, from one grouped query.
+        """
+        return self.period_trends(Period.month(year, month), event_ids=event_ids, recording_ids=recording_ids)
+
+    def period_trends(self, period, previous_period=None, event_ids=None, recording_ids=None):
+        """
+        Returns a dict keyed by event_id (or recording_id if recording_ids are given) with the
+        seconds_played and play_count of the period, the previous_seconds_played and
+        previous_play_count of the previous period (period.previous() by default), and the trend
+        percentages between them. Ids without any plays get zero counts and None trends.
+        """
+        previous_period = previous_period or period.previous()
+        if recording_ids is not None:
+            group_field, ids = 'recording_id', recording_ids
+        else:
+            group_field, ids = 'event_id', event_ids
+        qs = self.get_reporting_queryset().filter(period.q() | previous_period.q())
+        if ids is not None:
+            qs = qs.filter(**{group_field + '__in': ids})
+        grouped = qs.grouped_period_counts(group_field, current=period.q(), previous=previous_period.q())
+        if ids is None:
+            ids = grouped.keys()
+
+        empty = {'seconds_played': 0, 'play_count': 0}
+        trends = {}
+        for id_ in ids:
+            period_counts = grouped.get(id_, {})
+            counts = dict(period_counts.get('current', empty))
+            previous_counts = period_counts.get('previous', empty)
+            counts['previous_seconds_played'] = previous_counts['seconds_played']
+            counts['previous_play_count'] = previous_counts['play_count']
+            trends[id_] = self._add_trends(counts, previous_counts)
+        return trends
+
     def top_all_time_events(self, artist_event_ids=None):
-        qs = self.get_queryset()
-        if artist_event_ids:
-            qs = qs.filter(event_id__in=artist_event_ids)
+        qs = self.get_reporting_queryset().for_events(artist_event_ids)
         return qs.values('event_id').total_counts_annotate().order_by('-seconds_played')[:10]
 
     def create_random(self):
@@ -446,20 +636,231 @@ class MetricsManager(models.Manager):
                 params['event_id'] = rec.get('event_id')
                 self.create(**params)
 
-    def most_popular_audio(self, count=4, weekly=False, range_size=None):
-        return self.get_queryset().most_popular_audio(
-            weekly=weekly, range_size=range_size
-        )[:count]
+    def create_random_bulk(self, rows, users=10000, events=1000, days=365, video_share=0.5, zipf_exponent=1.1,
+                           end_date=None, chunk_size=10000, seed=None):
+        """
+        Inserts rows random metrics with bulk_create, spread evenly over the days up to end_date
+        (today by default). Events are picked with a Zipf distribution, event 1 being the most
+        popular, and every event has an audio recording with id event_id * 2 and a video one with
+        id event_id * 2 + 1. Users are picked uniformly and a user plays a recording once per day,
+        so it gets slow when rows / days comes close to users * events * 2. The daily rollups are
+        updated along.
+        """
+        if rows > users * events * 2 * days:
+            raise ValueError("{0} users can't have {1} rows over {2} days and {3} events".format(
+                users, rows, days, events))
+        rng = random.Random(seed)
+        end_date = end_date or today()
+        now = timezone.now()
+        weights = []
+        total = 0.0
+        for rank in range(1, events + 1):
+            total += 1.0 / rank ** zipf_exponent
+            weights.append(total)
+        created = 0
+        batch = []
+        for day_index in range(days):
+            day = end_date - datetime.timedelta(days=day_index)
+            day_rows = rows // days + (1 if day_index < rows % days else 0)
+            seen = set()
+            while len(seen) < day_rows:
+                event_id = min(bisect.bisect(weights, rng.random() * total) + 1, events)
+                is_video = rng.random() < video_share
+                recording_id = event_id * 2 + is_video
+                user_id = rng.randint(1, users)
+                if (recording_id, user_id) in seen:
+                    continue
+                seen.add((recording_id, user_id))
+                batch.append(self.model(
+                    recording_id=recording_id, user_id=user_id, date=day, event_id=event_id,
+                    recording_type='V' if is_video else 'A', seconds_played=rng.randrange(10, 3600, 10),
+                    play_count=rng.randint(1, 3), event_date=now))
+                if len(batch) >= chunk_size:
+                    created += self._create_bulk(batch)
+                    batch = []
+        return created + self._create_bulk(batch)
+
+    def _create_bulk(self, metrics):
+        with ingestion_atomic(using=self.db):
+            self.bulk_create(metrics)
+            DailyMetricRollup.objects.db_manager(self.db).add_deltas(metrics)
+        return len(metrics)
+
+    def upsert_ping(self, validated_data, now=None):
+        """
+        Applies a player ping with a single INSERT ... ON CONFLICT DO UPDATE statement instead of
+        locking the row with select_for_update. The ping interval and daily limit checks from
+        MetricView.passes_validation are part of the statement's WHERE clause and the hourly
+        play_count rule is a CASE expression, so concurrent pings for the same user/recording/day
+        can't lose increments or race into an IntegrityError.
+
+        Returns None if the ping was rejected, otherwise a dict with the applied deltas and
+        whether the row was created.
+        """
+        now = now or timezone.now()
+        metric = self.model(**validated_data)
+        metric.date = now.date()
+        metric.last_ping = now
+        if not (rollups_enabled() or leaderboards_enabled() or sketches_enabled()):
+            return self._upsert_ping(metric, now)
+        with ingestion_atomic(using=self.db):
+            applied = self._upsert_ping(metric, now)
+            if applied is not None:
+                DailyMetricRollup.objects.db_manager(self.db).add_ping(
+                    metric, applied['seconds_played'], applied['play_count'])
+        return applied
+
+    def _upsert_ping(self, metric, now):
+        connection = _upsert_connection(self.db)
+        last_ping_field = self.model._meta.get_field('last_ping')
+        update_sql = (
+            "{seconds_played} = {table}.{seconds_played} + %s, "
+            "{play_count} = {table}.{play_count} + CASE WHEN {table}.{last_ping} < %s THEN 1 ELSE 0 END, "
+            "{last_ping} = EXCLUDED.{last_ping} "
+            "WHERE {table}.{last_ping} <= %s AND {table}.{seconds_played} < %s"
+        )
+        if connection.vendor == 'postgresql':
+            # subqueries in RETURNING see the snapshot from before the statement, so this is the
+            # previous last_ping of an updated row and NULL for a freshly inserted one
+            update_sql += (
+                " RETURNING (SELECT previous.{last_ping} FROM {table} previous "
+                "WHERE previous.{id} = {table}.{id})"
+            )
+        sql, params = _upsert_sql(connection, self.model, [metric], ('recording_id', 'user_id', 'date'), update_sql)
+        play_threshold = now - datetime.timedelta(hours=1)
+        params += [
+            settings.PING_INTERVAL,
+            last_ping_field.get_db_prep_value(play_threshold, connection),
+            last_ping_field.get_db_prep_value(
+                now - datetime.timedelta(seconds=settings.PING_INTERVAL_WITH_BUFFER), connection),
+            settings.DAILY_LIMIT_PER_MEDIA,
+        ]
 
-    def most_popular_video(self, count=4, weekly=False, range_size=None):
-        return self.get_queryset().most_popular_video(
-            weekly=weekly, range_size=range_size
-        )[:count]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+            if row is None:
+                return None
+            previous_ping = row[0]
+        else:
+            # SQLite has no network round trip, so reading the previous ping separately is cheap.
+            # A ping racing with this read can only be accepted if its row state matches what we
+            # read, because a concurrent update moves last_ping past the ping interval check.
+            previous_ping = self.filter(
+                recording_id=metric.recording_id, user_id=metric.user_id, date=metric.date
+            ).values_list('last_ping', flat=True).first()
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                if cursor.rowcount == 0:
+                    return None
+
+        if previous_ping is None:
+            return {'created': True, 'seconds_played': metric.seconds_played, 'play_count': metric.play_count}
+        return {
+            'created': False,
+            'seconds_played': settings.PING_INTERVAL,
+            'play_count': 1 if previous_ping < play_threshold else 0,
+        }
 
-    def most_popular(self, count=4, weekly=False, range_size=None):
-        return self.get_queryset().most_popular(
-            weekly=weekly, range_size=range_size
-        )[:count]
+    def bulk_upsert_deltas(self, metrics):
+        """
+        Adds the seconds_played and play_count of the unsaved metrics onto the stored rows for the
+        same recording/user/day, inserting the rows that don't exist yet. The metrics are expected
+        to be validated already, e.g. by the ping buffer. Metrics for the same row are merged first
+        because a single statement can't update a row twice.
+        """
+        if not metrics:
+            return
+        merged = collections.OrderedDict()
+        for metric in metrics:
+            key = (metric.recording_id, metric.user_id, metric.date)
+            if key in merged:
+                previous = merged[key]
+                previous.seconds_played += metric.seconds_played
+                previous.play_count += metric.play_count
+                previous.last_ping = max(previous.last_ping, metric.last_ping)
+            else:
+                merged[key] = copy.copy(metric)
+        metrics = list(merged.values())
+
+        greatest = 'GREATEST' if connections[self.db].vendor == 'postgresql' else 'MAX'
+        update_sql = (
+            "{seconds_played} = {table}.{seconds_played} + EXCLUDED.{seconds_played}, "
+            "{play_count} = {table}.{play_count} + EXCLUDED.{play_count}, "
+            "{last_ping} = " + greatest + "({table}.{last_ping}, EXCLUDED.{last_ping})"
+        )
+        with ingestion_atomic(using=self.db, savepoint=False):
+            _bulk_upsert(self.db, self.model, metrics, ('recording_id', 'user_id', 'date'), update_sql)
+            DailyMetricRollup.objects.add_deltas(metrics)
+
+    def reserve_rows(self, metrics):
+        """
+        Inserts the rows of the unsaved metrics that don't exist yet with nothing played, so they
+        can be locked with select_for_update before their first ping is applied. Their last_ping is
+        reserved_last_ping() until bulk_upsert_deltas adds the first ping onto them.
+        """
+        reserved = []
+        for metric in metrics:
+            metric = copy.copy(metric)
+            metric.seconds_played = metric.play_count = 0
+            metric.last_ping = reserved_last_ping()
+            reserved.append(metric)
+        _bulk_upsert(self.db, self.model, reserved, ('recording_id', 'user_id', 'date'), None)
+
+    def compact(self, before, keep_event_ids=(), chunk_size=5000):
+        """
+        Folds the metrics from before the day before into DailyMetricRollup and deletes them, except
+        the per-user rows of keep_event_ids. The rollups of the days not compacted yet are rebuilt
+        from the rows one day per transaction, the new horizon is recorded so rebuilds leave those
+        days alone from then on, and the rows are deleted chunk_size at a time so no transaction
+        holds the table for long. Returns the number of deleted rows.
+        """
+        if not rollups_enabled():
+            raise ImproperlyConfigured("Compacting metrics needs METRICS_ROLLUP_ENABLED, the reports only see "
+                                       "the compacted days through the rollups")
+        horizon = MetricCompaction.objects.db_manager(self.db).horizon()
+        if horizon is None or horizon < before:
+            day = self.filter(date__lt=before).aggregate(first=Min('date'))['first'] or before
+            if horizon is not None:
+                day = max(day, horizon)
+            while day < before:
+                DailyMetricRollup.objects.db_manager(self.db).rebuild(day, day + datetime.timedelta(days=1))
+                day += datetime.timedelta(days=1)
+            MetricCompaction.objects.using(self.db).create(compacted_before=before)
+
+        qs = self.filter(date__lt=before).exclude(event_id__in=keep_event_ids)
+        deleted = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                pks = list(qs.values_list('pk', flat=True)[:chunk_size])
+                if not pks:
+                    break
+                self.filter(pk__in=pks).delete()
+            deleted += len(pks)
+        return deleted
+
+    def most_popular_audio(self, count=4, weekly=False, range_size=None, after=None):
+        return self._most_popular('A', count, weekly, range_size, after)
+
+    def most_popular_video(self, count=4, weekly=False, range_size=None, after=None):
+        return self._most_popular('V', count, weekly, range_size, after)
+
+    def most_popular(self, count=4, weekly=False, range_size=None, after=None):
+        return self._most_popular('', count, weekly, range_size, after)
+
+    def _most_popular(self, recording_type, count, weekly, range_size, after):
+        """
+        The count most played events as event_id and count (seconds_played) dicts. Read from the
+        leaderboards when METRICS_LEADERBOARDS_ENABLED is set, otherwise aggregated on the fly.
+        """
+        if leaderboards_enabled():
+            return LeaderboardEntry.objects.db_manager(self.reporting_db).top(
+                popular_range(weekly, range_size), recording_type, count, after)
+        qs = self.get_reporting_queryset()
+        if recording_type:
+            qs = qs.filter(recording_type=recording_type)
+        return qs.most_popular(weekly=weekly, range_size=range_size, after=after)[:count]
 
 
 class UserVideoMetric(models.Model):
@@ -477,7 +878,580 @@ class UserVideoMetric(models.Model):
 
     class Meta:
         unique_together = ('recording_id', 'user_id', 'date')
+        # the reports filter on a date range together with an event, a recording or a type
+        index_together = (
+            ('event_id', 'date'),
+            ('date', 'recording_type'),
+            ('recording_id', 'date'),
+        )
 
     def __str__(self):
         return "V{0} U{1} D{2.year}/{2.month}/{2.day} C{3}".format(
             self.recording_id, self.user_id, self.date, self.seconds_played)
+
+
+class MetricSpoolCheckpoint(models.Model):
+    """
+    How far drain_metric_spool got in a spool segment, by the segment's name without its open or
+    ready suffix. Updated in the same transaction as the metrics replayed from the segment, so a
+    restarted drain resumes exactly where the last committed batch ended, also once the segment
+    was rotated.
+    """
+    segment = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "{0} @{1}".format(self.segment, self.offset)
+
+
+class CompactionManager(models.Manager):
+    def horizon(self):
+        """
+        The day before which the raw metrics were compacted, None if they never were.
+        """
+        return self.aggregate(horizon=Max('compacted_before'))['horizon']
+
+
+class MetricCompaction(models.Model):
+    """
+    A compact_metrics run. The raw metrics from before compacted_before only survive in
+    DailyMetricRollup, apart from the events whose per-user rows were kept.
+    """
+    compacted_before = models.DateField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = CompactionManager()
+
+    def __str__(self):
+        return "Compacted before {}".format(self.compacted_before)
+
+
+class RollupManager(models.Manager):
+    def get_queryset(self):
+        return MetricsQuerySet(self.model, using=self._db)
+
+    def add_ping(self, metric, seconds_played, play_count):
+        delta = copy.copy(metric)
+        delta.seconds_played = seconds_played
+        delta.play_count = play_count
+        self.add_deltas([delta])
+
+    def add_deltas(self, metrics):
+        """
+        Adds the seconds_played and play_count deltas of the UserVideoMetric instances onto their
+        daily rollups if METRICS_ROLLUP_ENABLED is set, onto the leaderboards if
+        METRICS_LEADERBOARDS_ENABLED is set, and their listeners to the sketches if
+        METRICS_SKETCHES_ENABLED is set.
+        """
+        LeaderboardEntry.objects.db_manager(self.db).add_deltas(metrics)
+        ListenerSketch.objects.db_manager(self.db).add_listeners(metrics)
+        if not rollups_enabled():
+            return
+        rollups = collections.OrderedDict()
+        for metric in metrics:
+            if not (metric.seconds_played or metric.play_count):
+                continue
+            key = (metric.date, metric.event_id, metric.recording_id, metric.recording_type)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = self.model(
+                    date=metric.date, event_id=metric.event_id, recording_id=metric.recording_id,
+                    recording_type=metric.recording_type)
+            rollup.seconds_played += metric.seconds_played
+            rollup.play_count += metric.play_count
+        if not rollups:
+            return
+        update_sql = (
+            "{seconds_played} = {table}.{seconds_played} + EXCLUDED.{seconds_played}, "
+            "{play_count} = {table}.{play_count} + EXCLUDED.{play_count}"
+        )
+        _bulk_upsert(self.db, self.model, list(rollups.values()),
+                     ('date', 'event_id', 'recording_id', 'recording_type'), update_sql)
+
+    def rebuild(self, start_date=None, end_date=None, chunk_size=2000):
+        """
+        Recomputes the rollups from the raw metrics, for all days or the days from start_date up
+        to but excluding end_date. Days before the compaction horizon are left alone. The cached
+        archive data of the rebuilt months is invalidated once the new rollups are committed.
+        """
+        start_date, end_date = _uncompacted_range(self.db, start_date, end_date)
+        if start_date and end_date and end_date <= start_date:
+            return
+        raw = UserVideoMetric.objects.using(self.db)
+        rollups = self.all()
+        if start_date:
+            raw = raw.filter(date__gte=start_date)
+            rollups = rollups.filter(date__gte=start_date)
+        if end_date:
+            raw = raw.filter(date__lt=end_date)
+            rollups = rollups.filter(date__lt=end_date)
+        rows = raw.values('date', 'event_id', 'recording_id', 'recording_type').order_by().annotate(
+            seconds_played=Sum('seconds_played'), play_count=Sum('play_count'))
+        with transaction.atomic(using=self.db):
+            # the days rewritten, bounded by the data on either side when the range is open
+            bounds = [qs.aggregate(first=Min('date'), last=Max('date')) for qs in (raw, rollups)]
+            rollups.delete()
+            batch = []
+            for row in rows.iterator():
+                batch.append(self.model(**row))
+                if len(batch) >= chunk_size:
+                    self.bulk_create(batch)
+                    batch = []
+            self.bulk_create(batch)
+
+        firsts = [bound['first'] for bound in bounds if bound['first']]
+        lasts = [bound['last'] for bound in bounds if bound['last']]
+        if firsts:
+            bump_archive_months(start_date or min(firsts),
+                                end_date - datetime.timedelta(days=1) if end_date else max(lasts))
+
+    def mismatches(self, start_date=None, end_date=None):
+        """
+        Returns the (date, event_id, recording_id, recording_type) keys whose rollup doesn't
+        match the raw metrics, with the rollup and raw (seconds_played, play_count). Days before the
+        compaction horizon are skipped.
+        """
+        start_date, end_date = _uncompacted_range(self.db, start_date, end_date)
+        if start_date and end_date and end_date <= start_date:
+            return []
+        raw = UserVideoMetric.objects.using(self.db).all()
+        rollups = self.all()
+        if start_date:
+            raw = raw.filter(date__gte=start_date)
+            rollups = rollups.filter(date__gte=start_date)
+        if end_date:
+            raw = raw.filter(date__lt=end_date)
+            rollups = rollups.filter(date__lt=end_date)
+        key_fields = ('date', 'event_id', 'recording_id', 'recording_type')
+        expected = dict(
+            (tuple(row[name] for name in key_fields), (row['seconds_played'], row['play_count']))
+            for row in raw.values(*key_fields).order_by().annotate(
+                seconds_played=Sum('seconds_played'), play_count=Sum('play_count'))
+        )
+        mismatches = []
+        for row in rollups.values(*(key_fields + ('seconds_played', 'play_count'))):
+            key = tuple(row[name] for name in key_fields)
+            counts = (row['seconds_played'], row['play_count'])
+            raw_counts = expected.pop(key, (0, 0))
+            if counts != raw_counts:
+                mismatches.append((key, counts, raw_counts))
+        mismatches.extend((key, (0, 0), raw_counts) for key, raw_counts in expected.items())
+        return mismatches
+
+
+class DailyMetricRollup(models.Model):
+    """
+    seconds_played and play_count summed over all listeners per day and recording. Kept up to
+    date by every ingestion path when METRICS_ROLLUP_ENABLED is set, and used by the
+    MetricsManager reports instead of the per-listener rows then.
+    """
+    date = models.DateField()
+    event_id = models.PositiveIntegerField()
+    recording_id = models.IntegerField()
+    recording_type = models.CharField(max_length=1, choices=(('A', 'Audio'), ('V', 'Video')))
+    seconds_played = models.BigIntegerField(default=0)
+    play_count = models.BigIntegerField(default=0)
+
+    objects = RollupManager()
+
+    class Meta:
+        unique_together = ('date', 'event_id', 'recording_id', 'recording_type')
+        index_together = (
+            ('event_id', 'date'),
+            ('recording_id', 'date'),
+        )
+
+    def __str__(self):
+        return "E{0} R{1} D{2.year}/{2.month}/{2.day} C{3}".format(
+            self.event_id, self.recording_id, self.date, self.seconds_played)
+
+
+class LeaderboardManager(models.Manager):
+    def period_start(self, range_size, day=None):
+        if range_size == RANGE_ALL_TIME:
+            return ALL_TIME_START
+        return Period.containing(range_size, day).start
+
+    def add_deltas(self, metrics):
+        """
+        Adds the seconds_played deltas of the UserVideoMetric instances onto the leaderboards of
+        the week, month and year of their day and the all-time ones, both for their recording
+        type and for all types. Does nothing unless METRICS_LEADERBOARDS_ENABLED is set.
+        """
+        if not leaderboards_enabled():
+            return
+        entries = collections.OrderedDict()
+        for metric in metrics:
+            if not metric.seconds_played:
+                continue
+            for range_size in LEADERBOARD_RANGES:
+                period_start = self.period_start(range_size, metric.date)
+                for recording_type in ('', metric.recording_type):
+                    key = (range_size, recording_type, period_start, metric.event_id)
+                    entry = entries.get(key)
+                    if entry is None:
+                        entry = entries[key] = self.model(
+                            range_size=range_size, recording_type=recording_type, period_start=period_start,
+                            event_id=metric.event_id)
+                    entry.seconds_played += metric.seconds_played
+        if not entries:
+            return
+        _bulk_upsert(self.db, self.model, list(entries.values()),
+                     ('range_size', 'recording_type', 'period_start', 'event_id'),
+                     "{seconds_played} = {table}.{seconds_played} + EXCLUDED.{seconds_played}")
+
+    def top(self, range_size, recording_type='', count=4, after=None):
+        """
+        The count first events of the current leaderboard, or the ones after the popular_cursor
+        of an event, read in index order.
+        """
+        qs = self.filter(
+            range_size=range_size, recording_type=recording_type, period_start=self.period_start(range_size))
+        if after:
+            seconds_played, event_id = _parse_popular_cursor(after)
+            qs = qs.filter(Q(seconds_played__lt=seconds_played) | Q(seconds_played=seconds_played,
+                                                                    event_id__lt=event_id))
+        rows = qs.order_by('-seconds_played', '-event_id').values_list('event_id', 'seconds_played')[:count]
+        return [{'event_id': event_id, 'count': seconds_played} for event_id, seconds_played in rows]
+
+    def rebuild(self, range_sizes=None):
+        """
+        Recomputes the current leaderboards of range_sizes (all of them by default) from the
+        reporting queryset and deletes the ones of past periods.
+        """
+        for range_size in range_sizes or LEADERBOARD_RANGES:
+            period_start = self.period_start(range_size)
+            qs = UserVideoMetric.objects.db_manager(self.db).get_reporting_queryset()
+            if range_size != RANGE_ALL_TIME:
+                qs = Period.containing(range_size).filter(qs)
+            rows = qs.values('event_id', 'recording_type').order_by().annotate(seconds_played=Sum('seconds_played'))
+            entries = {}
+            for row in rows:
+                for recording_type in ('', row['recording_type']):
+                    key = (recording_type, row['event_id'])
+                    entry = entries.get(key)
+                    if entry is None:
+                        entry = entries[key] = self.model(
+                            range_size=range_size, recording_type=recording_type, period_start=period_start,
+                            event_id=row['event_id'])
+                    entry.seconds_played += row['seconds_played'] or 0
+            with transaction.atomic(using=self.db):
+                self.filter(range_size=range_size).delete()
+                self.bulk_create(entries.values(), batch_size=2000)
+
+
+class LeaderboardEntry(models.Model):
+    """
+    An event's seconds_played over a week, month, year (starting on period_start) or all time,
+    for one recording type or all of them (an empty recording_type). Kept up to date by every
+    ingestion path when METRICS_LEADERBOARDS_ENABLED is set, and used by most_popular instead of
+    aggregating the metrics then. A new period starts out empty.
+    """
+    range_size = models.CharField(max_length=5)
+    recording_type = models.CharField(max_length=1, blank=True)
+    period_start = models.DateField()
+    event_id = models.PositiveIntegerField()
+    seconds_played = models.BigIntegerField(default=0)
+
+    objects = LeaderboardManager()
+
+    class Meta:
+        unique_together = ('range_size', 'recording_type', 'period_start', 'event_id')
+        # the top of a leaderboard is read straight from the index
+        index_together = (
+            ('range_size', 'recording_type', 'period_start', 'seconds_played', 'event_id'),
+        )
+
+    def __str__(self):
+        return "{0}{1} {2} E{3} C{4}".format(
+            self.range_size, self.recording_type, self.period_start, self.event_id, self.seconds_played)
+
+
+class ListenerSketchManager(models.Manager):
+    def add_listeners(self, metrics):
+        """
+        Adds the user_id of the UserVideoMetric instances to the sketches of their day, event and
+        recording type, skipping the listeners this process already added. Missing sketches are
+        inserted empty first and all of them are then updated under select_for_update, so
+        concurrent ingestion can't lose a listener. Does nothing unless METRICS_SKETCHES_ENABLED
+        is set.
+        """
+        if not sketches_enabled():
+            return
+        pairs = seen_listeners.unseen(set(
+            ((metric.date, metric.event_id, metric.recording_type), metric.user_id) for metric in metrics))
+        if not pairs:
+            return
+        listeners = collections.defaultdict(set)
+        for key, user_id in pairs:
+            listeners[key].add(user_id)
+        keys = sorted(listeners)
+        empty = HyperLogLog().to_bytes()
+        with transaction.atomic(using=self.db, savepoint=False):
+            _bulk_upsert(self.db, self.model, [
+                self.model(date=day, event_id=event_id, recording_type=recording_type, sketch=empty)
+                for day, event_id, recording_type in keys
+            ], ('date', 'event_id', 'recording_type'), None)
+            rows = self.select_for_update().filter(
+                date__in=set(key[0] for key in keys), event_id__in=set(key[1] for key in keys),
+                recording_type__in=set(key[2] for key in keys),
+            ).order_by('date', 'event_id', 'recording_type').values_list(
+                'pk', 'date', 'event_id', 'recording_type', 'sketch')
+            for pk, day, event_id, recording_type, data in rows:
+                user_ids = listeners.get((day, event_id, recording_type))
+                if not user_ids:
+                    continue
+                sketch = HyperLogLog.from_bytes(data)
+                if [user_id for user_id in user_ids if sketch.add(user_id)]:
+                    self.filter(pk=pk).update(sketch=sketch.to_bytes())
+        if transaction.get_connection(self.db).in_atomic_block:
+            # the caller's transaction can still roll the updates back
+            seen_listeners.defer(self.db, pairs)
+        else:
+            seen_listeners.add(pairs)
+
+    def period_listeners(self, event_ids=None, **periods):
+        """
+        Estimated unique listeners of event_ids (all events by default) for every named Period,
+        None meaning all time, from one query merging the daily sketches. See metrics.sketches
+        for the error bounds.
+        """
+        return self._merged_listeners(event_ids, periods).get(None, dict((name, 0) for name in periods))
+
+    def event_period_listeners(self, event_ids, **periods):
+        """
+        Like period_listeners, for every event separately from the same single query, keyed by
+        event id.
+        """
+        listeners = self._merged_listeners(event_ids, periods, by_event=True)
+        return dict((event_id, listeners.get(event_id, dict((name, 0) for name in periods)))
+                    for event_id in event_ids)
+
+    def _merged_listeners(self, event_ids, periods, by_event=False):
+        qs = self.all()
+        if event_ids is not None:
+            qs = qs.filter(event_id__in=event_ids)
+        if periods and None not in periods.values():
+            qs = qs.filter(date__gte=min(period.start for period in periods.values()),
+                           date__lt=max(period.end for period in periods.values()))
+        sketches = {}
+        for event_id, day, data in qs.values_list('event_id', 'date', 'sketch').iterator():
+            group = event_id if by_event else None
+            group_sketches = sketches.get(group)
+            if group_sketches is None:
+                group_sketches = sketches[group] = dict((name, HyperLogLog()) for name in periods)
+            for name, period in periods.items():
+                if period is None or day in period:
+                    group_sketches[name].update_from_bytes(data)
+        return dict(
+            (group, dict((name, sketch.count()) for name, sketch in group_sketches.items()))
+            for group, group_sketches in sketches.items()
+        )
+
+    def backfill(self, start_date=None, end_date=None):
+        """
+        Rebuilds the sketches from the raw metrics, for all days or the days from start_date up to
+        but excluding end_date, one day per transaction. Days before the compaction horizon are
+        left alone. Returns the number of sketches written.
+        """
+        start_date, end_date = _uncompacted_range(self.db, start_date, end_date)
+        raw = UserVideoMetric.objects.using(self.db)
+        bounds = raw.aggregate(first=Min('date'), last=Max('date'))
+        if bounds['first'] is None:
+            return 0
+        day = max(start_date or bounds['first'], bounds['first'])
+        last_day = bounds['last']
+        if end_date:
+            last_day = min(last_day, end_date - datetime.timedelta(days=1))
+        written = 0
+        while day <= last_day:
+            sketches = collections.defaultdict(HyperLogLog)
+            rows = raw.filter(date=day).values_list('event_id', 'recording_type', 'user_id')
+            for event_id, recording_type, user_id in rows.iterator():
+                sketches[(event_id, recording_type)].add(user_id)
+            with transaction.atomic(using=self.db):
+                self.filter(date=day).delete()
+                self.bulk_create([
+                    self.model(date=day, event_id=event_id, recording_type=recording_type, sketch=sketch.to_bytes())
+                    for (event_id, recording_type), sketch in sketches.items()
+                ], batch_size=1000)
+            written += len(sketches)
+            day += datetime.timedelta(days=1)
+        return written
+
+
+class ListenerSketch(models.Model):
+    """
+    A HyperLogLog sketch of the listeners of an event's recordings of one type on a day. Kept up
+    to date by every ingestion path when METRICS_SKETCHES_ENABLED is set, and merged into the
+    unique_listeners estimates of counts_for_event and all_time_for_artist then. Survives
+    compact_metrics, unlike the per-user rows it's built from.
+    """
+    date = models.DateField()
+    event_id = models.PositiveIntegerField()
+    recording_type = models.CharField(max_length=1, choices=(('A', 'Audio'), ('V', 'Video')))
+    sketch = models.BinaryField()
+
+    objects = ListenerSketchManager()
+
+    class Meta:
+        unique_together = ('date', 'event_id', 'recording_type')
+        index_together = (
+            ('event_id', 'date'),
+        )
+
+    def __str__(self):
+        return "E{0} {1} D{2.year}/{2.month}/{2.day}".format(self.event_id, self.recording_type, self.date)
+
+
+class ArtistEventManager(models.Manager):
+    def event_ids(self, artist_id):
+        """
+        The artist's event ids as a lazy queryset, which the MetricsManager reports take in place
+        of an id list and send as a subquery.
+        """
+        return self.filter(artist_id=artist_id).values_list('event_id', flat=True)
+
+    def set_events(self, artist_id, event_ids):
+        """
+        Replaces the artist's events with event_ids, returns whether they changed.
+        """
+        event_ids = set(event_ids)
+        with transaction.atomic(using=self.db):
+            current = set(self.select_for_update().filter(artist_id=artist_id).values_list('event_id', flat=True))
+            removed = current - event_ids
+            added = event_ids - current
+            if removed:
+                self.filter(artist_id=artist_id, event_id__in=removed).delete()
+            self.bulk_create([self.model(artist_id=artist_id, event_id=event_id) for event_id in sorted(added)])
+        if removed or added:
+            bump_artist_version(artist_id)
+            return True
+        return False
+
+    def sync(self, mapping, replace_all=False):
+        """
+        Sets the events of every artist_id in mapping to its event ids. With replace_all, the
+        artists missing from mapping lose all their events. Returns the ids of the artists whose
+        events changed.
+        """
+        changed = [artist_id for artist_id, event_ids in sorted(mapping.items())
+                   if self.set_events(artist_id, event_ids)]
+        if replace_all:
+            stale = set(self.values_list('artist_id', flat=True).distinct()) - set(mapping)
+            for artist_id in sorted(stale):
+                if self.set_events(artist_id, ()):
+                    changed.append(artist_id)
+        return changed
+
+
+class ArtistEvent(models.Model):
+    """
+    An event an artist played, synced from the main site by the sync_artist_events command or
+    the artist_events endpoint, so the artist reports can be asked for by artist_id.
+    """
+    artist_id = models.PositiveIntegerField()
+    event_id = models.PositiveIntegerField()
+
+    objects = ArtistEventManager()
+
+    class Meta:
+        unique_together = ('artist_id', 'event_id')
+
+    def __str__(self):
+        return "A{0} E{1}".format(self.artist_id, self.event_id)
+
+
+class PayoutSnapshotManager(models.Manager):
+    def take(self, year, month):
+        """
+        Stores every event's seconds_played, play_count and share of the month's seconds_played,
+        from one grouped pass over the reporting queryset, and the same summed over the events of
+        every artist in ArtistEvent at that point. An event of several artists counts fully for
+        each of them. A month can only have one snapshot, it's never updated afterwards.
+        """
+        metrics = UserVideoMetric.objects.db_manager(self.db)
+        period = Period.month(year, month)
+        rows = list(period.filter(metrics.get_reporting_queryset()).values('event_id').order_by('event_id').annotate(
+            seconds_played=Sum('seconds_played'), play_count=Sum('play_count')))
+        total_seconds_played = sum(row['seconds_played'] for row in rows)
+        total_play_count = sum(row['play_count'] for row in rows)
+
+        artist_counts = collections.OrderedDict()
+        event_counts = dict((row['event_id'], row) for row in rows)
+        artist_events = ArtistEvent.objects.db_manager(self.db).order_by('artist_id')
+        for artist_id, event_id in artist_events.values_list('artist_id', 'event_id').iterator():
+            if event_id not in event_counts:
+                continue
+            counts = artist_counts.setdefault(artist_id, {'seconds_played': 0, 'play_count': 0})
+            counts['seconds_played'] += event_counts[event_id]['seconds_played']
+            counts['play_count'] += event_counts[event_id]['play_count']
+
+        with transaction.atomic(using=self.db):
+            snapshot = self.create(month=period.start, total_seconds_played=total_seconds_played,
+                                   total_play_count=total_play_count)
+            PayoutShare.objects.db_manager(self.db).bulk_create([
+                PayoutShare(snapshot=snapshot, event_id=row['event_id'], seconds_played=row['seconds_played'],
+                            play_count=row['play_count'],
+                            share=metrics._calculate_percentage(row['seconds_played'], total_seconds_played))
+                for row in rows
+            ], batch_size=1000)
+            PayoutArtistShare.objects.db_manager(self.db).bulk_create([
+                PayoutArtistShare(snapshot=snapshot, artist_id=artist_id, seconds_played=counts['seconds_played'],
+                                  play_count=counts['play_count'],
+                                  share=metrics._calculate_percentage(counts['seconds_played'], total_seconds_played))
+                for artist_id, counts in artist_counts.items()
+            ], batch_size=1000)
+        return snapshot
+
+
+class PayoutSnapshot(models.Model):
+    """
+    The payout shares of a closed month, taken once by the compute_payout_snapshot command so
+    they no longer move when late pings arrive.
+    """
+    month = models.DateField(unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+    total_seconds_played = models.BigIntegerField()
+    total_play_count = models.BigIntegerField()
+
+    objects = PayoutSnapshotManager()
+
+    def __str__(self):
+        return "Payouts {0.year}/{0.month}".format(self.month)
+
+
+class PayoutShare(models.Model):
+    """
+    An event's counts in a PayoutSnapshot, share being its percentage of the month's
+    seconds_played.
+    """
+    snapshot = models.ForeignKey(PayoutSnapshot, related_name='shares')
+    event_id = models.PositiveIntegerField()
+    seconds_played = models.BigIntegerField()
+    play_count = models.BigIntegerField()
+    share = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = ('snapshot', 'event_id')
+
+    def __str__(self):
+        return "E{0} {1}%".format(self.event_id, self.share)
+
+
+class PayoutArtistShare(models.Model):
+    """
+    An artist's counts in a PayoutSnapshot, summed over the events the artist had when it was
+    taken.
+    """
+    snapshot = models.ForeignKey(PayoutSnapshot, related_name='artist_shares')
+    artist_id = models.PositiveIntegerField()
+    seconds_played = models.BigIntegerField()
+    play_count = models.BigIntegerField()
+    share = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = ('snapshot', 'artist_id')
+
+    def __str__(self):
+        return "A{0} {1}%".format(self.artist_id, self.share)
@@ -0,0 +1,161 @@
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+YEAR = 'year'
+DAYS = 'days'
+
+GRANULARITIES = (DAY, WEEK, MONTH)
+
+
+def today():
+    return timezone.now().date()
+
+
+def add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    year, month = divmod(month_index, 12)
+    return datetime.date(year, month + 1, 1)
+
+
+class Period(object):
+    """
+    A half-open range of days, start included and end excluded. Reports filter on it with
+    date__gte/date__lt, which keeps the date column bare so an index on it can be range scanned,
+    unlike date__month/date__year lookups that wrap the column in EXTRACT.
+    """
+
+    def __init__(self, start, end, kind=DAYS):
+        if end < start:
+            raise ValueError("Period end {} is before its start {}".format(end, start))
+        self.start = start
+        self.end = end
+        self.kind = kind
+
+    @classmethod
+    def week(cls, day=None):
+        """
+        The Monday to Sunday week containing day, today by default.
+        """
+        day = day or today()
+        start = day - datetime.timedelta(days=day.weekday())
+        return cls(start, start + datetime.timedelta(weeks=1), WEEK)
+
+    @classmethod
+    def month(cls, year=None, month=None):
+        """
+        A calendar month, the current one by default.
+        """
+        if year is None or month is None:
+            current = today()
+            year, month = current.year, current.month
+        start = datetime.date(year, month, 1)
+        return cls(start, add_months(start, 1), MONTH)
+
+    @classmethod
+    def year(cls, year=None):
+        year = year or today().year
+        return cls(datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1), YEAR)
+
+    @classmethod
+    def containing(cls, kind, day=None):
+        """
+        The week, month or year period containing day, today by default.
+        """
+        day = day or today()
+        if kind == WEEK:
+            return cls.week(day)
+        if kind == MONTH:
+            return cls.month(day.year, day.month)
+        if kind == YEAR:
+            return cls.year(day.year)
+        raise ValueError("Unknown period kind {}".format(kind))
+
+    @classmethod
+    def rolling_days(cls, days, last_day=None):
+        """
+        The last days days, up to and including last_day (today by default).
+        """
+        end = (last_day or today()) + datetime.timedelta(days=1)
+        return cls(end - datetime.timedelta(days=days), end)
+
+    @classmethod
+    def between(cls, first_day, last_day):
+        """
+        An arbitrary range with both days included, like date__range.
+        """
+        return cls(first_day, last_day + datetime.timedelta(days=1))
+
+    @property
+    def days(self):
+        return (self.end - self.start).days
+
+    @property
+    def last_day(self):
+        return self.end - datetime.timedelta(days=1)
+
+    def previous(self):
+        """
+        The period right before this one: the previous calendar month or year for month and year
+        periods, otherwise the same number of days.
+        """
+        if self.kind == MONTH:
+            return Period(add_months(self.start, -1), self.start, MONTH)
+        if self.kind == YEAR:
+            return Period.year(self.start.year - 1)
+        return Period(self.start - datetime.timedelta(days=self.days), self.start, self.kind)
+
+    def is_closed(self, day=None):
+        """
+        Whether the period ended before day (today by default), so its data can't change anymore.
+        """
+        return self.end <= (day or today())
+
+    def buckets(self, granularity):
+        """
+        Splits the period into consecutive day, ISO week or calendar month periods. The first and
+        last buckets are cut to the period, so their start isn't always a Monday or a 1st.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError("Unknown granularity {}".format(granularity))
+        buckets = []
+        start = self.start
+        while start < self.end:
+            if granularity == DAY:
+                end = start + datetime.timedelta(days=1)
+            elif granularity == WEEK:
+                end = start + datetime.timedelta(days=7 - start.weekday())
+            else:
+                end = add_months(start, 1)
+            end = min(end, self.end)
+            buckets.append(Period(start, end, granularity))
+            start = end
+        return buckets
+
+    def lookups(self, field='date'):
+        return {field + '__gte': self.start, field + '__lt': self.end}
+
+    def q(self, field='date'):
+        return Q(**self.lookups(field))
+
+    def filter(self, qs, field='date'):
+        return qs.filter(**self.lookups(field))
+
+    def __contains__(self, day):
+        return self.start <= day < self.end
+
+    def __eq__(self, other):
+        return isinstance(other, Period) and (self.start, self.end) == (other.start, other.end)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.start, self.end))
+
+    def __repr__(self):
+        return "<Period {0} {1}..{2}>".format(self.kind, self.start, self.end)
@@ -0,0 +1,11 @@
+from rest_framework.permissions import BasePermission
+
+
+class IsSuperUser(BasePermission):
+    """
+    Allows access to superusers only. DRF's IsAdminUser reads is_staff, which SmallsUser doesn't
+    have, while is_superuser comes with its PermissionsMixin.
+    """
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_superuser)
@@ -0,0 +1,116 @@
+import collections
+from datetime import timedelta
+
+from django.conf import settings
+
+from .models import UserVideoMetric, reserved_last_ping
+
+
+def ping_key(validated_data, now):
+    return (
+        validated_data['recording_id'],
+        validated_data['recording_type'],
+        validated_data['event_id'],
+        validated_data['user_id'],
+        now.date(),
+    )
+
+
+def load_states(keys, for_update=False):
+    """
+    Returns the stored (last_ping, seconds_played) for every ping key in one query, None for the
+    rows that don't exist yet or were only reserved. With for_update the rows stay locked until
+    the transaction ends.
+    """
+    keys = list(keys)
+    states = dict.fromkeys(keys)
+    if not keys:
+        return states
+    by_row = dict(((key[0], key[3], key[4]), key) for key in keys)
+    rows = UserVideoMetric.objects.filter(
+        recording_id__in=set(key[0] for key in keys),
+        user_id__in=set(key[3] for key in keys),
+        date__in=set(key[4] for key in keys),
+    )
+    if for_update:
+        rows = rows.select_for_update()
+    rows = rows.values_list('recording_id', 'user_id', 'date', 'last_ping', 'seconds_played')
+    for recording_id, user_id, date, last_ping, seconds_played in rows:
+        key = by_row.get((recording_id, user_id, date))
+        if key is not None and last_ping != reserved_last_ping():
+            states[key] = (last_ping, seconds_played)
+    return states
+
+
+def check_ping(state, validated_data, now):
+    """
+    Applies the MetricView.passes_validation rules to a ping against the (last_ping,
+    seconds_played) state of its row, None if the row doesn't exist yet. Returns None if the
+    ping is rejected, otherwise the applied deltas and the new state.
+    """
+    if state is None:
+        metric = UserVideoMetric(**validated_data)
+        applied = {'created': True, 'seconds_played': metric.seconds_played, 'play_count': metric.play_count}
+        return applied, (now, metric.seconds_played)
+
+    last_ping, seconds_played = state
+    allowed_ping_interval = now >= last_ping + timedelta(seconds=settings.PING_INTERVAL_WITH_BUFFER)
+    if not (allowed_ping_interval and seconds_played < settings.DAILY_LIMIT_PER_MEDIA):
+        return None
+    applied = {
+        'created': False,
+        'seconds_played': settings.PING_INTERVAL,
+        'play_count': 1 if last_ping + timedelta(hours=1) < now else 0,
+    }
+    return applied, (now, seconds_played + settings.PING_INTERVAL)
+
+
+def empty_metric(key, validated_data, now):
+    return UserVideoMetric(
+        recording_id=key[0], recording_type=key[1], event_id=key[2], user_id=key[3], date=key[4],
+        event_date=validated_data.get('event_date', now), seconds_played=0, play_count=0)
+
+
+def add_delta(pending, key, validated_data, applied, now):
+    """
+    Merges the applied deltas of a ping into the unsaved metric kept for its key in pending.
+    """
+    metric = pending.get(key)
+    if metric is None:
+        metric = pending[key] = empty_metric(key, validated_data, now)
+    metric.seconds_played += applied['seconds_played']
+    metric.play_count += applied['play_count']
+    metric.last_ping = max(metric.last_ping, now) if metric.last_ping else now
+    return metric
+
+
+def apply_pings(pings, for_update=False):
+    """
+    Runs check_ping over the (now, validated_data) pings in the given order against the stored
+    rows and writes the merged deltas of the applied ones with one bulk upsert. Returns the
+    applied deltas of every ping, None for the rejected ones. Meant to run in a transaction.
+
+    With for_update the missing rows are reserved first, a row that doesn't exist can't be locked
+    and a racing ping or batch would count it as created as well. It now waits for this
+    transaction and sees the row as it was left.
+    """
+    first_pings = collections.OrderedDict()
+    for now, validated_data in pings:
+        first_pings.setdefault(ping_key(validated_data, now), (now, validated_data))
+    if for_update:
+        UserVideoMetric.objects.reserve_rows([
+            empty_metric(key, validated_data, now) for key, (now, validated_data) in first_pings.items()])
+    states = load_states(first_pings, for_update)
+    pending = {}
+    results = []
+    for now, validated_data in pings:
+        key = ping_key(validated_data, now)
+        result = check_ping(states[key], validated_data, now)
+        if result is None:
+            results.append(None)
+            continue
+        applied, states[key] = result
+        add_delta(pending, key, validated_data, applied, now)
+        results.append(applied)
+    UserVideoMetric.objects.bulk_upsert_deltas(list(pending.values()))
+    return results
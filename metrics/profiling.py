@@ -0,0 +1,271 @@
+import atexit
+import bisect
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.test.utils import CaptureQueriesContext
+
+from .routers import primary_alias, reporting_alias
+
+# upper bounds of the histogram buckets, the last bucket takes everything above
+BUCKETS = tuple(2 ** exponent for exponent in range(21))
+SNAPSHOT_SUFFIX = '.profile.json'
+
+logger = logging.getLogger(__name__)
+
+
+# METRICS_PROFILING is read once, every profiled call checks it
+_switch = {}
+
+
+def profiling_enabled():
+    enabled = _switch.get('enabled')
+    if enabled is None:
+        enabled = _switch['enabled'] = getattr(settings, 'METRICS_PROFILING', False)
+    return enabled
+
+
+@receiver(setting_changed)
+def reset_profiling_switch(setting, **kwargs):
+    if setting == 'METRICS_PROFILING':
+        _switch.clear()
+
+
+class Histogram(object):
+    """
+    Counts of values in power of two buckets, enough for percentiles within a factor of two at a
+    constant cost per value.
+    """
+
+    def __init__(self, counts=None, total=0, maximum=0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.total = total
+        self.maximum = maximum
+
+    @property
+    def calls(self):
+        return sum(self.counts)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, fraction):
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= fraction * self.calls:
+                return min(BUCKETS[index], self.maximum) if index < len(BUCKETS) else self.maximum
+        return 0
+
+    def summary(self):
+        calls = self.calls
+        return {
+            'total': round(self.total, 3),
+            'mean': round(self.total / calls, 3) if calls else 0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': round(self.maximum, 3),
+        }
+
+    def state(self):
+        return {'counts': self.counts, 'total': self.total, 'maximum': self.maximum}
+
+
+class Profiler(object):
+    """
+    Per-process histograms of the wall time, queries and returned rows of every profiled call.
+    If METRICS_PROFILE_DIR is set, the process also dumps them there every
+    METRICS_PROFILE_DUMP_INTERVAL seconds and at exit, so they can be merged with the other
+    processes' by the stats endpoint and the metrics_profile command.
+    """
+    metrics = ('time_ms', 'queries', 'rows')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_dump = time.time()
+
+    def record(self, name, time_ms, queries, rows=None):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = dict((metric, Histogram()) for metric in self.metrics)
+            stats['time_ms'].add(time_ms)
+            stats['queries'].add(queries)
+            if rows is not None:
+                stats['rows'].add(rows)
+            now = time.time()
+            should_dump = now - self._last_dump >= getattr(settings, 'METRICS_PROFILE_DUMP_INTERVAL', 10)
+            if should_dump:
+                # claimed under the lock, so only one of the racing calls dumps
+                self._last_dump = now
+        if should_dump:
+            self.dump()
+
+    def state(self):
+        with self._lock:
+            return dict(
+                (name, dict((metric, histogram.state()) for metric, histogram in stats.items()))
+                for name, stats in self._stats.items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+        path = self.snapshot_path()
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def snapshot_path(self):
+        profile_dir = getattr(settings, 'METRICS_PROFILE_DIR', None)
+        if profile_dir:
+            return os.path.join(profile_dir, "{}{}".format(os.getpid(), SNAPSHOT_SUFFIX))
+
+    def dump(self):
+        """
+        Writes the snapshot through a temporary file renamed over it, so readers never see a
+        partial one. Failures are only logged, profiling mustn't fail the profiled request.
+        """
+        with self._lock:
+            self._last_dump = time.time()
+        path = self.snapshot_path()
+        if not path or not self._stats:
+            return
+        profile_dir = os.path.dirname(path)
+        temp_path = None
+        try:
+            if not os.path.isdir(profile_dir):
+                try:
+                    os.makedirs(profile_dir)
+                except OSError:
+                    if not os.path.isdir(profile_dir):
+                        raise  # not just another process creating it first
+            fd, temp_path = tempfile.mkstemp(dir=profile_dir, prefix=os.path.basename(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.state(), f)
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logger.exception("Dumping the metrics profile to {} failed".format(path))
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+profiler = Profiler()
+
+
+@atexit.register
+def dump_profile():
+    if profiling_enabled():
+        profiler.dump()
+
+
+def collect_stats():
+    """
+    Merges this process's histograms with the snapshots the other processes dumped to
+    METRICS_PROFILE_DIR and returns their summaries by call name, the most expensive first.
+    """
+    states = [profiler.state()]
+    profile_dir = getattr(settings, 'METRICS_PROFILE_DIR', None)
+    if profile_dir and os.path.isdir(profile_dir):
+        own_snapshot = profiler.snapshot_path()
+        for name in os.listdir(profile_dir):
+            path = os.path.join(profile_dir, name)
+            if name.endswith(SNAPSHOT_SUFFIX) and path != own_snapshot:
+                try:
+                    with open(path) as f:
+                        states.append(json.load(f))
+                except (IOError, ValueError):
+                    continue
+
+    merged = {}
+    for state in states:
+        for name, histograms in state.items():
+            stats = merged.setdefault(name, dict((metric, Histogram()) for metric in Profiler.metrics))
+            for metric, histogram_state in histograms.items():
+                stats[metric].merge(Histogram(**histogram_state))
+    summaries = [
+        dict(name=name, calls=stats['time_ms'].calls,
+             **dict((metric, histogram.summary()) for metric, histogram in stats.items()))
+        for name, stats in merged.items()
+    ]
+    return sorted(summaries, key=lambda summary: -summary['time_ms']['total'])
+
+
+def _rows(result):
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return None
+
+
+@contextmanager
+def captured_queries():
+    """
+    Captures the queries run on the primary and, when the reports go to a replica, on the replica,
+    yielding the CaptureQueriesContext of each.
+    """
+    contexts = [CaptureQueriesContext(connections[alias]) for alias in set([primary_alias(), reporting_alias()])]
+    for context in contexts:
+        context.__enter__()
+    try:
+        yield contexts
+    finally:
+        for context in reversed(contexts):
+            context.__exit__(None, None, None)
+
+
+def profile_call(name, func, *args, **kwargs):
+    if not profiling_enabled():
+        return func(*args, **kwargs)
+    with captured_queries() as contexts:
+        start = time.time()
+        result = func(*args, **kwargs)
+        time_ms = (time.time() - start) * 1000
+    profiler.record(name, time_ms, sum(len(queries) for queries in contexts), _rows(result))
+    return result
+
+
+def profiled(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return profile_call(name, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_methods(exclude=()):
+    """
+    Class decorator profiling every public method the class defines, as Class.method. Lazy
+    querysets returned by a method only run their query once the caller evaluates them, so
+    their cost shows up in the calling method or view instead.
+    """
+    def decorator(cls):
+        for name, value in list(vars(cls).items()):
+            if callable(value) and not name.startswith('_') and name not in exclude:
+                setattr(cls, name, profiled("{0}.{1}".format(cls.__name__, name))(value))
+        return cls
+    return decorator
+
+
+class ProfiledViewMixin(object):
+    def dispatch(self, request, *args, **kwargs):
+        return profile_call(self.__class__.__name__, super(ProfiledViewMixin, self).dispatch,
+                            request, *args, **kwargs)
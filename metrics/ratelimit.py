@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+RATE_LIMIT_KEY = 'metrics:ratelimit:{0}:{1}'
+REJECTED_KEY = 'metrics:rejected:{}'
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# reasons rejected pings are counted under
+RATE_LIMITED = 'rate_limited'
+FAILED_VALIDATION = 'failed_validation'
+REJECTION_REASONS = (RATE_LIMITED, FAILED_VALIDATION)
+
+
+def rate_limit_enabled():
+    return getattr(settings, 'METRICS_RATE_LIMIT_ENABLED', False)
+
+
+def shared_cache():
+    alias = getattr(settings, 'METRICS_RATE_LIMIT_CACHE_ALIAS', None)
+    return caches[alias] if alias else None
+
+
+class PingRateLimiter(object):
+    """
+    A token bucket per (user_id, recording_id) refilled with one ping every
+    PING_INTERVAL_WITH_BUFFER seconds, up to METRICS_RATE_LIMIT_BURST pings, and capped at the
+    pings DAILY_LIMIT_PER_MEDIA allows per day. It turns away abusive or broken clients before
+    any database work, the exact ping interval and daily limit checks still happen in the
+    database. The buckets are kept in a bounded LRU per process, or in the
+    METRICS_RATE_LIMIT_CACHE_ALIAS cache shared by all processes, where two concurrent pings of
+    the same bucket can both get through.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    @property
+    def burst(self):
+        return getattr(settings, 'METRICS_RATE_LIMIT_BURST', 3)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'METRICS_RATE_LIMIT_SIZE', 100000)
+
+    def daily_pings(self):
+        return settings.DAILY_LIMIT_PER_MEDIA // settings.PING_INTERVAL + self.burst
+
+    def allow(self, user_id, recording_id, now=None):
+        """
+        Takes a ping from the bucket, returns False if it's empty or the day's pings are used up.
+        now is the ping's time in epoch seconds, the current time by default. A ping older than
+        the bucket's last one, e.g. from a batch of buffered pings, refills nothing and counts
+        against the bucket's day.
+        """
+        now = now or time.time()
+        key = (user_id, recording_id)
+        cache = shared_cache()
+        if cache is not None:
+            state = cache.get(RATE_LIMIT_KEY.format(*key))
+        else:
+            with self._lock:
+                state = self._buckets.pop(key, None)
+
+        tokens, updated, day, day_pings = state or (self.burst, now, None, 0)
+        tokens = min(self.burst, tokens + max(now - updated, 0) / float(settings.PING_INTERVAL_WITH_BUFFER))
+        if day is None or day < int(now // SECONDS_PER_DAY):
+            day, day_pings = int(now // SECONDS_PER_DAY), 0
+        allowed = tokens >= 1 and day_pings < self.daily_pings()
+        if allowed:
+            tokens -= 1
+            day_pings += 1
+        state = (tokens, max(updated, now), day, day_pings)
+
+        if cache is not None:
+            cache.set(RATE_LIMIT_KEY.format(*key), state, SECONDS_PER_DAY)
+        else:
+            with self._lock:
+                self._buckets[key] = state
+                while len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+        return allowed
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+ping_rate_limiter = PingRateLimiter()
+
+
+class RejectionCounter(object):
+    """
+    Counts of the rejected pings by reason, kept in the METRICS_RATE_LIMIT_CACHE_ALIAS cache
+    when it's set so they cover all the processes, otherwise per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict((reason, 0) for reason in REJECTION_REASONS)
+
+    def add(self, reason, count=1):
+        cache = shared_cache()
+        if cache is None:
+            with self._lock:
+                self._counts[reason] += count
+            return
+        key = REJECTED_KEY.format(reason)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            if not cache.add(key, count, None):
+                cache.incr(key, count)
+
+    def counts(self):
+        cache = shared_cache()
+        if cache is None:
+            with self._lock:
+                return dict(self._counts)
+        return dict((reason, cache.get(REJECTED_KEY.format(reason), 0)) for reason in REJECTION_REASONS)
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict((reason, 0) for reason in REJECTION_REASONS)
+        cache = shared_cache()
+        if cache is not None:
+            cache.delete_many([REJECTED_KEY.format(reason) for reason in REJECTION_REASONS])
+
+
+rejected_pings = RejectionCounter()
+
+
+class ThrottledLogger(object):
+    """
+    Logs a warning at most once every METRICS_REJECTION_LOG_INTERVAL seconds per key, with the
+    number of warnings dropped since, so a misbehaving client can't flood the logs.
+    """
+
+    def __init__(self, logger, max_keys=10000):
+        self.logger = logger
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+
+    def warning(self, key, message):
+        now = time.time()
+        interval = getattr(settings, 'METRICS_REJECTION_LOG_INTERVAL', 60)
+        with self._lock:
+            logged_at, suppressed = self._keys.pop(key, (None, 0))
+            if logged_at is not None and now - logged_at < interval:
+                self._keys[key] = (logged_at, suppressed + 1)
+                return
+            self._keys[key] = (now, 0)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        if suppressed:
+            message = "{0} ({1} similar warnings suppressed)".format(message, suppressed)
+        self.logger.warning(message)
@@ -0,0 +1,30 @@
+from rest_framework.renderers import JSONRenderer
+
+# element type of the report columns, all of them are sums of plays or minutes
+COLUMN_TYPE = 'uint'
+
+
+class ColumnarRenderer(JSONRenderer):
+    """
+    Compact JSON for the reports in the columnar format, chosen with ?format=columnar or by
+    accepting its media type.
+    """
+    media_type = 'application/vnd.smallslive.columnar+json'
+    format = 'columnar'
+    compact = True
+
+
+def columnar(counts):
+    """
+    The lists of a date_counts or date_series report as columns sharing its dates axis, named
+    without their _list suffix, e.g. audio_plays_list becomes the audio_plays column.
+    """
+    columns = dict((name[:-len('_list')], values) for name, values in counts.items() if name.endswith('_list'))
+    data = {
+        'dates': [day.isoformat() if hasattr(day, 'isoformat') else day for day in counts['dates']],
+        'type': COLUMN_TYPE,
+        'columns': columns,
+    }
+    if 'granularity' in counts:
+        data['granularity'] = counts['granularity']
+    return data
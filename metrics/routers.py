@@ -0,0 +1,60 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_local = threading.local()
+
+
+def primary_alias():
+    return getattr(settings, 'METRICS_PRIMARY_ALIAS', DEFAULT_DB_ALIAS)
+
+
+def reporting_alias():
+    """
+    The database the MetricsManager reports read from: METRICS_REPLICA_ALIAS if it's set, the
+    primary without a replica or inside primary_reads().
+    """
+    replica = getattr(settings, 'METRICS_REPLICA_ALIAS', None)
+    if replica is None or getattr(_local, 'primary_reads', 0):
+        return primary_alias()
+    return replica
+
+
+@contextmanager
+def primary_reads():
+    """
+    Sends the reports run inside it to the primary, for callers that need to read their own
+    writes. A single call can do the same with UserVideoMetric.objects.db_manager(alias).
+    """
+    _local.primary_reads = getattr(_local, 'primary_reads', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary_reads -= 1
+
+
+class MetricsRouter(object):
+    """
+    Keeps every metrics query that doesn't name its database on the primary, so the ping path's
+    reads, row locks and writes never see a lagging replica. Only the reports go to
+    METRICS_REPLICA_ALIAS, by naming it through MetricsManager.reporting_db. Add it to
+    DATABASE_ROUTERS along with the replica alias.
+    """
+    app_label = 'metrics'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return primary_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return primary_alias()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == self.app_label and obj2._meta.app_label == self.app_label:
+            return True
+        return None
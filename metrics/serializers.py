@@ -1,5 +1,5 @@
 from rest_framework import fields, serializers
-from .models import UserVideoMetric
+from .models import PayoutArtistShare, PayoutShare, PayoutSnapshot, UserVideoMetric
 
 
 class UserVideoMetricSerializer(serializers.ModelSerializer):
@@ -11,6 +11,39 @@ class UserVideoMetricSerializer(serializers.ModelSerializer):
         validators = []
 
 
+class PingBatchItemSerializer(serializers.Serializer):
+    signed_data = fields.CharField()
+    timestamp = fields.DateTimeField(required=False)
+
+
+class PayoutShareSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = PayoutShare
+        fields = ('event_id', 'seconds_played', 'play_count', 'share')
+
+
+class PayoutArtistShareSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = PayoutArtistShare
+        fields = ('artist_id', 'seconds_played', 'play_count', 'share')
+
+
+class PayoutSnapshotSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = PayoutSnapshot
+        fields = ('month', 'created', 'total_seconds_played', 'total_play_count')
+
+
+class ArtistEventsSerializer(serializers.Serializer):
+    artist_id = fields.IntegerField(min_value=1)
+    event_ids = fields.ListField(
+        child=fields.IntegerField(min_value=1)
+    )
+
+
 class MonthMetricsSerializer(serializers.Serializer):
     dates = fields.ListField(
         child=fields.CharField(min_length=3, max_length=5)
@@ -57,3 +90,28 @@ class MonthMetricsSerializer(serializers.Serializer):
         child=fields.IntegerField(min_value=0),
         required=False
     )
+
+
+class SeriesMetricsSerializer(serializers.Serializer):
+    granularity = fields.CharField()
+    dates = fields.ListField(
+        child=fields.DateField()
+    )
+    video_minutes_list = fields.ListField(
+        child=fields.IntegerField(min_value=0)
+    )
+    audio_minutes_list = fields.ListField(
+        child=fields.IntegerField(min_value=0)
+    )
+    total_minutes_list = fields.ListField(
+        child=fields.IntegerField(min_value=0)
+    )
+    video_plays_list = fields.ListField(
+        child=fields.IntegerField(min_value=0)
+    )
+    audio_plays_list = fields.ListField(
+        child=fields.IntegerField(min_value=0)
+    )
+    total_plays_list = fields.ListField(
+        child=fields.IntegerField(min_value=0)
+    )
@@ -0,0 +1,294 @@
+import atexit
+import errno
+import fcntl
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .cache import bump_archive_versions
+from .models import MetricSpoolCheckpoint, ingestion_atomic
+from .pings import apply_pings
+from .serializers import UserVideoMetricSerializer
+
+logger = logging.getLogger(__name__)
+
+OPEN_SUFFIX = '.open'
+READY_SUFFIX = '.ready'
+
+
+def get_spool_dir():
+    spool_dir = getattr(settings, 'METRICS_SPOOL_DIR', None)
+    if not spool_dir:
+        raise ImproperlyConfigured("METRICS_SPOOL_DIR needs to be set to use the metric spool")
+    return spool_dir
+
+
+def segment_stem(name):
+    """
+    The name of a segment without its suffix, which stays the same when the segment is rotated
+    from open to ready, so its checkpoint follows it.
+    """
+    for suffix in (OPEN_SUFFIX, READY_SUFFIX):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PingSpool(object):
+    """
+    Append-only spool of verified pings. Every process appends JSON lines to its own open
+    segment in METRICS_SPOOL_DIR and rotates it to a ready segment once it reaches
+    METRICS_SPOOL_SEGMENT_BYTES or METRICS_SPOOL_SEGMENT_SECONDS. Lines are written straight
+    to the file, so they survive a process crash, and fsync'd every METRICS_SPOOL_FSYNC_BATCH
+    pings or METRICS_SPOOL_FSYNC_INTERVAL seconds, which bounds what a power loss can take. A
+    timer thread syncs the segment when no ping arrives to do it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fd = None
+        self._path = None
+        self._pid = None
+        self._opened_at = 0
+        self._size = 0
+        self._unsynced = 0
+        self._last_sync = 0
+        self._timer_pid = None
+
+    @property
+    def fsync_interval(self):
+        return getattr(settings, 'METRICS_SPOOL_FSYNC_INTERVAL', 1)
+
+    def append(self, data):
+        with self._lock:
+            # received is taken under the lock so every segment is in receive order
+            now = timezone.now()
+            line = json.dumps({'received': now.isoformat(), 'data': data}, separators=(',', ':')) + '\n'
+            line = line.encode('utf-8')
+            self._ensure_segment(now)
+            os.write(self._fd, line)
+            self._size += len(line)
+            self._unsynced += 1
+            if (self._unsynced >= getattr(settings, 'METRICS_SPOOL_FSYNC_BATCH', 100) or
+                    time.time() - self._last_sync >= self.fsync_interval):
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                self._close_segment()
+
+    def _sync(self):
+        os.fsync(self._fd)
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _ensure_timer(self):
+        # started lazily and per process, so forking servers get a timer in every worker
+        if self._timer_pid == self._pid:
+            return
+        self._timer_pid = self._pid
+        thread = threading.Thread(target=self._run_timer, name='metrics-ping-spool')
+        thread.daemon = True
+        thread.start()
+
+    def _run_timer(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if self._fd is not None and self._pid == os.getpid() and self._unsynced:
+                    try:
+                        self._sync()
+                    except OSError:
+                        logger.exception("Syncing spool segment {} failed".format(self._path))
+
+    def _ensure_segment(self, now):
+        if self._fd is not None and self._pid != os.getpid():
+            # inherited from the parent of a forked worker, the parent still owns the segment
+            os.close(self._fd)
+            self._fd = None
+        if self._fd is not None:
+            too_big = self._size >= getattr(settings, 'METRICS_SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024)
+            too_old = time.time() - self._opened_at >= getattr(settings, 'METRICS_SPOOL_SEGMENT_SECONDS', 60)
+            if not (too_big or too_old):
+                return
+            self._close_segment()
+
+        spool_dir = get_spool_dir()
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        name = "{0:%Y%m%d%H%M%S%f}-{1}".format(now, os.getpid())
+        self._path = os.path.join(spool_dir, name + OPEN_SUFFIX)
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._pid = os.getpid()
+        self._opened_at = time.time()
+        self._size = 0
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._ensure_timer()
+
+    def _close_segment(self):
+        self._sync()
+        os.close(self._fd)
+        os.rename(self._path, self._path[:-len(OPEN_SUFFIX)] + READY_SUFFIX)
+        _fsync_dir(os.path.dirname(self._path))
+        self._fd = None
+        self._path = None
+
+
+ping_spool = PingSpool()
+
+
+@atexit.register
+def close_ping_spool():
+    ping_spool.close()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _read_segment(index, path, offset, horizon):
+    """
+    Yields (received, index, end offset, data) for the complete lines of a segment after offset,
+    stopping at the first ping received at or after horizon. Corrupt lines are yielded with
+    None as data so the checkpoint moves past them.
+    """
+    received = datetime.min.replace(tzinfo=timezone.utc)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                return  # still being written, or cut short by a crash
+            offset += len(line)
+            try:
+                record = json.loads(line.decode('utf-8'))
+                data = record['data']
+                received = parse_datetime(record['received'])
+            except (ValueError, KeyError, TypeError):
+                logger.warning("Skipping corrupt spool line in {} at {}".format(path, offset - len(line)))
+                yield received, index, offset, None
+                continue
+            if received >= horizon:
+                return
+            yield received, index, offset, data
+
+
+class SpoolDrainer(object):
+    """
+    Replays spooled pings into UserVideoMetric. Segments are merged in receive order and every
+    batch runs the same validation as the synchronous path against the stored rows, then writes
+    the merged deltas and the segment checkpoints in one transaction.
+    """
+
+    def __init__(self, batch_size=5000, settle_seconds=5):
+        self.batch_size = batch_size
+        # pings received this close to the start of the drain may still be in flight
+        self.settle_seconds = settle_seconds
+        self.spool_dir = get_spool_dir()
+        self.stats = {'pings': 0, 'applied': 0, 'rejected': 0, 'invalid': 0, 'segments': 0}
+
+    def drain(self):
+        if not os.path.isdir(self.spool_dir):
+            return self.stats
+        with open(os.path.join(self.spool_dir, 'drain.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            horizon = timezone.now() - timedelta(seconds=self.settle_seconds)
+            segments = self._collect_segments()
+            offsets = self._offsets(segments)
+            readers = [
+                _read_segment(index, os.path.join(self.spool_dir, segment), offsets.get(segment_stem(segment), 0),
+                              horizon)
+                for index, segment in enumerate(segments)
+            ]
+            records = heapq.merge(*readers)
+            while True:
+                batch = [record for _, record in zip(range(self.batch_size), records)]
+                if not batch:
+                    break
+                self._apply_batch(batch, segments)
+            self._remove_drained(segments)
+        return self.stats
+
+    def _collect_segments(self):
+        segments = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            if name.endswith(OPEN_SUFFIX):
+                pid = int(name[:-len(OPEN_SUFFIX)].rsplit('-', 1)[1])
+                if not _pid_alive(pid):
+                    # the writer died without rotating, nothing else will touch the segment
+                    ready = name[:-len(OPEN_SUFFIX)] + READY_SUFFIX
+                    os.rename(os.path.join(self.spool_dir, name), os.path.join(self.spool_dir, ready))
+                    name = ready
+            elif not name.endswith(READY_SUFFIX):
+                continue
+            segments.append(name)
+        # checkpoints of segments removed by an earlier drain that crashed before cleaning up
+        MetricSpoolCheckpoint.objects.exclude(segment__in=[segment_stem(segment) for segment in segments]).delete()
+        return sorted(segments)
+
+    def _offsets(self, segments):
+        return dict(MetricSpoolCheckpoint.objects.filter(
+            segment__in=[segment_stem(segment) for segment in segments]).values_list('segment', 'offset'))
+
+    def _apply_batch(self, batch, segments):
+        pings = []
+        for received, index, offset, data in batch:
+            serializer = UserVideoMetricSerializer(data=data) if data is not None else None
+            if serializer is not None and serializer.is_valid():
+                pings.append((received, serializer.validated_data))
+            else:
+                self.stats['invalid'] += 1
+
+        checkpoints = {}
+        for received, index, offset, data in batch:
+            checkpoints[segment_stem(segments[index])] = offset
+        with ingestion_atomic():
+            results = apply_pings(pings)
+            for segment, offset in checkpoints.items():
+                updated = MetricSpoolCheckpoint.objects.filter(segment=segment).update(offset=offset)
+                if not updated:
+                    MetricSpoolCheckpoint.objects.create(segment=segment, offset=offset)
+        bump_archive_versions(set(received.date() for received, validated_data in pings))
+        applied = len([result for result in results if result is not None])
+        self.stats['applied'] += applied
+        self.stats['rejected'] += len(results) - applied
+        self.stats['pings'] += len(batch)
+
+    def _remove_drained(self, segments):
+        offsets = self._offsets(segments)
+        for segment in segments:
+            if not segment.endswith(READY_SUFFIX):
+                continue
+            path = os.path.join(self.spool_dir, segment)
+            with open(path, 'rb') as f:
+                f.seek(offsets.get(segment_stem(segment), 0))
+                rest = f.read()
+            if b'\n' in rest:
+                continue
+            if rest:
+                logger.warning("Dropping incomplete last line of spool segment {}".format(path))
+            os.remove(path)
+            MetricSpoolCheckpoint.objects.filter(segment=segment_stem(segment)).delete()
+            self.stats['segments'] += 1
@@ -1,3 +1,485 @@
-from django.test import TestCase
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from unittest import skipIf
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .benchmarks import report_calls
+from .buffer import ping_buffer
+from .cache import get_metrics_cache
+from .export import export_rows
+from .management.commands import check_metric_query_plans
+from .models import DailyMetricRollup, ListenerSketch, UserVideoMetric
+from .periods import Period, today
+from .pings import apply_pings
+from .profiling import logger as profiling_logger, profiler
+from .ratelimit import ping_rate_limiter
+from .routers import primary_reads
+from .serializers import UserVideoMetricSerializer
+from .sketches import seen_listeners
+from .views import metric_batch_view, metric_view
+
+EVENT_IDS = [1, 2, 3, 4, 5]
+RECORDING_IDS = [event_id * 2 for event_id in EVENT_IDS]
+# a second configured database stands in for the read replica
+REPLICA_ALIAS = next((alias for alias in sorted(settings.DATABASES) if alias != DEFAULT_DB_ALIAS), None)
+
+
+def ping_data(recording_id=1, user_id=1, event_id=1, recording_type='A'):
+    return {
+        'recording_id': recording_id, 'recording_type': recording_type, 'event_id': event_id, 'user_id': user_id,
+        'seconds_played': settings.PING_INTERVAL, 'play_count': 1,
+        'event_date': timezone.make_aware(datetime.datetime(2015, 1, 1, 20), timezone.utc),
+    }
+
+
+def validated_ping(**kwargs):
+    serializer = UserVideoMetricSerializer(data=signing.loads(signed_ping(**kwargs)))
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data
+
+
+def signed_ping(**kwargs):
+    data = ping_data(**kwargs)
+    data['event_date'] = data['event_date'].isoformat()
+    return signing.dumps(data)
+
+
+def post(view, data, user_id=1):
+    # an unsaved user, the metrics views only read its id
+    request = APIRequestFactory().post('/', data, format='json', HTTP_REFERER=settings.SMALLSLIVE_SITE)
+    force_authenticate(request, user=get_user_model()(id=user_id, email='listener@example.com'))
+    return view(request)
+
+
+def run_in_threads(target, count):
+    """
+    Runs target(index) in count threads started together, each with its own database connection,
+    and returns the exceptions they raised.
+    """
+    errors = []
+    barrier = threading.Event()
+
+    def run(index):
+        try:
+            barrier.wait()
+            target(index)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+@override_settings(METRICS_INGESTION_MODE='upsert')
+class UpsertPingConcurrencyTest(TransactionTestCase):
+    """
+    Needs a database taking writes from several connections: the shared in-memory SQLite test
+    database fails concurrent writers instead of making them wait, so it's skipped there. Run it
+    on PostgreSQL, or on SQLite with an on-disk test database in the test settings:
+
+        DATABASES['default']['TEST'] = {'NAME': '/tmp/metrics_test.sqlite3'}
+    """
+    threads = 8
+    pings = 5
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db(connection.settings_dict['NAME']):
+            self.skipTest("in-memory SQLite can't take concurrent writes, set an on-disk TEST NAME")
+
+    def test_racing_first_pings(self):
+        now = timezone.now()
+        results = []
+        errors = run_in_threads(lambda index: results.append(UserVideoMetric.objects.upsert_ping(ping_data(), now)),
+                                self.threads)
+        self.assertFalse([error for error in errors if isinstance(error, IntegrityError)])
+        self.assertEqual(errors, [])
+        metric = UserVideoMetric.objects.get()
+        self.assertEqual(metric.seconds_played, settings.PING_INTERVAL)
+        self.assertEqual(metric.play_count, 1)
+        # the others came too soon after the first one
+        self.assertEqual(len([result for result in results if result is not None]), 1)
+
+    @override_settings(PING_INTERVAL_WITH_BUFFER=0)
+    def test_no_lost_increments(self):
+        # without the interval check every ping is applied, so each one has to add up
+        now = timezone.now()
+
+        def ping(index):
+            for _ in range(self.pings):
+                if UserVideoMetric.objects.upsert_ping(ping_data(), now) is None:
+                    raise AssertionError("Ping rejected")
+
+        errors = run_in_threads(ping, self.threads)
+        self.assertEqual(errors, [])
+        metric = UserVideoMetric.objects.get()
+        self.assertEqual(metric.seconds_played, self.threads * self.pings * settings.PING_INTERVAL)
+        self.assertEqual(metric.play_count, 1)
+
+
+class BatchPingConcurrencyTest(TransactionTestCase):
+    """
+    Needs the same database as UpsertPingConcurrencyTest.
+    """
+    threads = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db(connection.settings_dict['NAME']):
+            self.skipTest("in-memory SQLite can't take concurrent writes, set an on-disk TEST NAME")
+
+    @override_settings(METRICS_ROLLUP_ENABLED=True)
+    def test_racing_first_pings(self):
+        now = timezone.now()
+        results = []
+
+        def apply(index):
+            with transaction.atomic():
+                results.extend(apply_pings([(now, ping_data())], for_update=True))
+
+        errors = run_in_threads(apply, self.threads)
+        self.assertEqual(errors, [])
+        metric = UserVideoMetric.objects.get()
+        self.assertEqual(metric.seconds_played, settings.PING_INTERVAL)
+        self.assertEqual(metric.play_count, 1)
+        # only one batch created the row, the others came too soon after its ping
+        self.assertEqual([result['created'] for result in results if result is not None], [True])
+        self.assertEqual(DailyMetricRollup.objects.get().seconds_played, settings.PING_INTERVAL)
+
+
+class RollupParityTest(TestCase):
+    """
+    The same pings, sent through every ingestion path, have to give the same reports from the raw
+    metrics and from the rollups.
+    """
+
+    def ingest(self):
+        now = timezone.now()
+        for index, event_id in enumerate(EVENT_IDS):
+            recording_type = 'AV'[index % 2]
+            ping = signed_ping(recording_id=event_id * 2, event_id=event_id, user_id=1, recording_type=recording_type)
+            self.assertEqual(post(metric_view, {'signed_data': ping}).status_code, 201)
+
+        with override_settings(METRICS_INGESTION_MODE='upsert'):
+            for user_id in (2, 3, 4):
+                for event_id in EVENT_IDS[:3]:
+                    data = validated_ping(recording_id=event_id * 2, event_id=event_id, user_id=user_id)
+                    UserVideoMetric.objects.upsert_ping(data, now - datetime.timedelta(minutes=90))
+                    UserVideoMetric.objects.upsert_ping(data, now - datetime.timedelta(minutes=20))
+                    # too soon, rejected
+                    UserVideoMetric.objects.upsert_ping(data, now - datetime.timedelta(minutes=20, seconds=-1))
+
+        ping_buffer.clear()
+        for user_id in (5, 6):
+            for event_id in EVENT_IDS[1:]:
+                data = validated_ping(recording_id=event_id * 2, event_id=event_id, user_id=user_id,
+                                      recording_type='V')
+                ping_buffer.add(data, now - datetime.timedelta(minutes=30))
+                ping_buffer.add(data, now - datetime.timedelta(minutes=10))
+        ping_buffer.flush()
+
+        pings = []
+        for event_id in (1, 4):
+            for minutes in (50, 40, 40):
+                pings.append({
+                    'signed_data': signed_ping(recording_id=event_id * 2, event_id=event_id, user_id=7),
+                    'timestamp': (now - datetime.timedelta(minutes=minutes)).isoformat(),
+                })
+        self.assertEqual(post(metric_batch_view, {'pings': pings}, user_id=7).status_code, 200)
+
+    def reports(self):
+        results = []
+        for name, call in report_calls(EVENT_IDS, RECORDING_IDS):
+            get_metrics_cache().clear()
+            results.append((name, call()))
+        return results
+
+    def test_reports_match_raw_metrics(self):
+        reports = {}
+        for enabled in (False, True):
+            with override_settings(METRICS_ROLLUP_ENABLED=enabled):
+                UserVideoMetric.objects.all().delete()
+                DailyMetricRollup.objects.all().delete()
+                self.ingest()
+                if enabled:
+                    self.assertEqual(DailyMetricRollup.objects.mismatches(), [])
+                reports[enabled] = self.reports()
+        self.assertTrue(UserVideoMetric.objects.exists())
+        for (name, raw), (_, rolled_up) in zip(reports[False], reports[True]):
+            self.assertEqual(raw, rolled_up, name)
+
+
+@override_settings(METRICS_RATE_LIMIT_ENABLED=True, METRICS_RATE_LIMIT_BURST=3)
+class BatchRateLimitTest(TestCase):
+    def setUp(self):
+        ping_rate_limiter.clear()
+
+    def batch(self, timestamps):
+        pings = [{'signed_data': signed_ping(recording_id=2, user_id=3), 'timestamp': timestamp.isoformat()}
+                 for timestamp in timestamps]
+        response = post(metric_batch_view, {'pings': pings}, user_id=3)
+        return [result['status'] for result in response.data['results']]
+
+    def test_batch_pings_are_charged_to_the_bucket(self):
+        now = timezone.now()
+        self.assertEqual(self.batch([now] * 5), [201, 403, 403, 429, 429])
+        self.assertEqual(UserVideoMetric.objects.get().seconds_played, settings.PING_INTERVAL)
+
+    def test_spaced_batch_pings_refill_the_bucket(self):
+        interval = datetime.timedelta(seconds=settings.PING_INTERVAL_WITH_BUFFER)
+        now = timezone.now()
+        self.assertEqual(self.batch([now - interval * count for count in range(5, -1, -1)]),
+                         [201] + [204] * 5)
+
+
+@override_settings(METRICS_SKETCHES_ENABLED=True)
+class ListenerSketchTest(TestCase):
+    def setUp(self):
+        seen_listeners.clear()
+
+    def test_lock_mode_first_ping_is_counted(self):
+        self.assertEqual(post(metric_view, {'signed_data': signed_ping(recording_id=2, user_id=3)}).status_code, 201)
+        self.assertEqual(UserVideoMetric.objects.get().date, timezone.now().date())
+        self.assertEqual(ListenerSketch.objects.period_listeners(month=Period.month()), {'month': 1})
+
+
+@override_settings(METRICS_SKETCHES_ENABLED=True)
+class SeenListenersRollbackTest(TransactionTestCase):
+    def setUp(self):
+        seen_listeners.clear()
+
+    def test_rolled_back_listener_is_added_again(self):
+        data = validated_ping(recording_id=2, user_id=3)
+        pair = ((today(), data['event_id'], data['recording_type']), data['user_id'])
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                UserVideoMetric.objects.upsert_ping(data)
+                raise IntegrityError("rolled back by the caller")
+        self.assertEqual(seen_listeners.unseen([pair]), [pair])
+
+        UserVideoMetric.objects.upsert_ping(data)
+        self.assertEqual(seen_listeners.unseen([pair]), [])
+        self.assertEqual(ListenerSketch.objects.period_listeners(month=Period.month()), {'month': 1})
+
+
+class ArchiveCountsQueriesTest(TestCase):
+    # (days ago, event_id, seconds_played, play_count)
+    rows = [(0, 1, 600, 2), (0, 2, 300, 1), (800, 2, 900, 4)]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.last_week = Period.week().previous().start
+        cls.last_month = Period.month().previous().start
+        rows = [(today() - datetime.timedelta(days=days), event_id, seconds_played, play_count)
+                for days, event_id, seconds_played, play_count in cls.rows]
+        rows += [(cls.last_week, 1, 1200, 3), (cls.last_month, 1, 60, 1)]
+        cls.seeded = rows
+        UserVideoMetric.objects.bulk_create([
+            UserVideoMetric(date=date, event_id=event_id, recording_id=event_id * 2, user_id=index,
+                            recording_type='A', seconds_played=seconds_played, play_count=play_count,
+                            last_ping=timezone.now(), event_date=timezone.now())
+            for index, (date, event_id, seconds_played, play_count) in enumerate(rows)
+        ])
+
+    def expected(self, period=None, event_id=None):
+        # the seeded seconds_played and play_count within period, of all events or one
+        seconds_played = play_count = 0
+        for date, row_event_id, row_seconds_played, row_play_count in self.seeded:
+            if (period is None or period.start <= date < period.end) and event_id in (None, row_event_id):
+                seconds_played += row_seconds_played
+                play_count += row_play_count
+        return {'seconds_played': seconds_played, 'play_count': play_count}
+
+    def test_total_archive_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            counts = UserVideoMetric.objects.total_archive_counts(trends=True)
+        self.assertEqual(counts['all_time'], {'seconds_played': 3060, 'play_count': 11})
+        for name, period in (('week', Period.week()), ('month', Period.month())):
+            expected = self.expected(period)
+            previous = self.expected(period.previous())
+            self.assertEqual(counts[name]['seconds_played'], expected['seconds_played'])
+            self.assertEqual(counts[name]['play_count'], expected['play_count'])
+            self.assertEqual(counts[name]['play_count_trend'], (
+                (expected['play_count'] - previous['play_count']) / float(previous['play_count']) * 100
+                if previous['play_count'] else None))
+
+    def test_counts_for_event_takes_string_ids(self):
+        self.assertEqual(UserVideoMetric.objects.counts_for_event('1'), UserVideoMetric.objects.counts_for_event(1))
+        self.assertEqual(list(UserVideoMetric.objects.counts_for_events(['2'])), [2])
+
+    def test_counts_for_event_in_two_queries(self):
+        with self.assertNumQueries(2):
+            counts = UserVideoMetric.objects.counts_for_event(1)
+        self.assertEqual(counts['all_time']['seconds_played'], 1860)
+        self.assertEqual(counts['all_time']['play_count'], 6)
+        self.assertAlmostEqual(counts['all_time']['seconds_played_percentage'], 1860 * 100.0 / 3060)
+        for name, period in (('week', Period.week()), ('month', Period.month())):
+            expected = self.expected(period, event_id=1)
+            self.assertEqual(counts[name]['seconds_played'], expected['seconds_played'])
+            self.assertEqual(counts[name]['play_count'], expected['play_count'])
+
+
+class QueryPlanTest(TestCase):
+    """
+    Runs the check_metric_query_plans checks on the test database: every filtered report query
+    has to use an index.
+    """
+
+    def test_report_queries_use_indexes(self):
+        output = six.StringIO()
+        command = check_metric_query_plans.Command(stdout=output)
+        command.seed(rows=5000, days=100, events=50)
+        failures = command.check_plans(range(1, 51))
+        self.assertEqual(failures, 0, output.getvalue())
+
+
+@skipIf(REPLICA_ALIAS is None, "needs a second database to act as the read replica")
+@override_settings(METRICS_REPLICA_ALIAS=REPLICA_ALIAS, DATABASE_ROUTERS=['metrics.routers.MetricsRouter'])
+class ReadReplicaTest(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        # the replica lags behind, it has none of the primary's rows
+        UserVideoMetric.objects.db_manager(REPLICA_ALIAS).create(
+            date=today(), event_id=1, recording_id=2, user_id=1, recording_type='A', seconds_played=600,
+            play_count=2, last_ping=timezone.now(), event_date=timezone.now())
+
+    def captured(self, call):
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as primary, \
+                CaptureQueriesContext(connections[REPLICA_ALIAS]) as replica:
+            result = call()
+        return result, len(primary), len(replica)
+
+    def test_reports_read_the_replica(self):
+        now = today()
+        for call in (lambda: UserVideoMetric.objects.total_archive_counts(trends=True),
+                     lambda: UserVideoMetric.objects.counts_for_events([1, 2]),
+                     lambda: UserVideoMetric.objects.date_counts(now.month, now.year, [1])):
+            result, primary_queries, replica_queries = self.captured(call)
+            self.assertEqual(primary_queries, 0)
+            self.assertTrue(replica_queries)
+        counts = UserVideoMetric.objects.total_archive_counts()
+        self.assertEqual(counts['all_time']['seconds_played'], 600)
+        with primary_reads():
+            self.assertEqual(UserVideoMetric.objects.total_archive_counts()['all_time']['seconds_played'], 0)
+
+    def test_user_export_reads_the_replica(self):
+        rows, primary_queries, replica_queries = self.captured(
+            lambda: list(export_rows(Period.month(), ('event_id', 'user_id'))))
+        self.assertEqual(primary_queries, 0)
+        self.assertEqual([(row['user_id'], row['seconds_played']) for row in rows], [(1, 600)])
+
+    def test_query_plans_read_the_primary(self):
+        command = check_metric_query_plans.Command(stdout=six.StringIO())
+        result, primary_queries, replica_queries = self.captured(lambda: command.check_plans([1, 2]))
+        self.assertTrue(primary_queries)
+        self.assertEqual(replica_queries, 0)
+
+    def test_pings_write_the_primary(self):
+        for mode in ('lock', 'upsert'):
+            with override_settings(METRICS_INGESTION_MODE=mode):
+                ping = {'signed_data': signed_ping(recording_id=4, user_id=2)}
+                response, primary_queries, replica_queries = self.captured(lambda: post(metric_view, ping))
+                self.assertEqual(response.status_code, 201)
+                self.assertTrue(primary_queries)
+                self.assertEqual(replica_queries, 0)
+                self.assertEqual(UserVideoMetric.objects.using(DEFAULT_DB_ALIAS).count(), 1)
+                UserVideoMetric.objects.using(DEFAULT_DB_ALIAS).delete()
+        self.assertEqual(UserVideoMetric.objects.using(REPLICA_ALIAS).count(), 1)
+
+    @override_settings(METRICS_PROFILING=True)
+    def test_profiling_counts_replica_queries(self):
+        profiler.reset()
+        UserVideoMetric.objects.total_archive_counts()
+        queries = profiler.state()['MetricsManager.total_archive_counts']['queries']
+        self.assertEqual(queries['total'], 1)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        yesterday = today() - datetime.timedelta(days=1)
+        for day in (yesterday, today()):
+            for user_id in (1, 2, 3):
+                for event_id in (1, 2):
+                    UserVideoMetric.objects.create(
+                        date=day, event_id=event_id, recording_id=event_id * 2, user_id=user_id,
+                        recording_type='A', seconds_played=60 * user_id, play_count=1,
+                        last_ping=timezone.now(), event_date=timezone.now())
+        self.period = Period.between(yesterday, today())
+
+    def test_chunks_resume_after_the_last_group(self):
+        with primary_reads():
+            for dimensions in (('event_id', 'user_id'), ('date', 'event_id', 'user_id'), ('recording_type',)):
+                self.assertEqual(list(export_rows(self.period, dimensions, chunk_size=2)),
+                                 list(export_rows(self.period, dimensions)))
+            rows = export_rows(self.period, ('event_id', 'user_id'), chunk_size=2)
+            self.assertEqual(
+                [(row['event_id'], row['user_id'], row['seconds_played']) for row in rows],
+                [(event_id, user_id, 120 * user_id) for event_id in (1, 2) for user_id in (1, 2, 3)])
+
+
+@override_settings(METRICS_PROFILING=True, METRICS_PROFILE_DUMP_INTERVAL=0)
+class ProfilerDumpTest(TestCase):
+    def setUp(self):
+        profiler.reset()
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+
+    def test_dump_replaces_the_snapshot(self):
+        with override_settings(METRICS_PROFILE_DIR=self.profile_dir):
+            for _ in range(2):
+                UserVideoMetric.objects.total_archive_counts()
+            self.assertEqual(os.listdir(self.profile_dir), [os.path.basename(profiler.snapshot_path())])
+
+    def test_dump_failure_doesnt_fail_the_call(self):
+        not_a_dir = os.path.join(self.profile_dir, 'file')
+        open(not_a_dir, 'w').close()
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        profiling_logger.addHandler(handler)
+        profiling_logger.propagate = False
+        try:
+            with override_settings(METRICS_PROFILE_DIR=os.path.join(not_a_dir, 'profile')):
+                UserVideoMetric.objects.total_archive_counts()
+        finally:
+            profiling_logger.removeHandler(handler)
+            profiling_logger.propagate = True
+        self.assertEqual(profiler.state()['MetricsManager.total_archive_counts']['queries']['total'], 1)
+        self.assertTrue(logged)
+
+
+@override_settings(METRICS_ROLLUP_ENABLED=True)
+class RollupRebuildCacheTest(TestCase):
+    def test_rebuild_invalidates_closed_months(self):
+        last_month = Period.month().previous()
+        UserVideoMetric.objects.create(
+            date=last_month.start, event_id=1, recording_id=2, user_id=1, recording_type='A', seconds_played=600,
+            play_count=1, last_ping=timezone.now(), event_date=timezone.now())
+        get_metrics_cache().clear()
+
+        def total_plays():
+            counts = UserVideoMetric.objects.archive_date_counts(last_month.start.month, last_month.start.year)
+            return sum(counts['total_plays_list'])
+
+        # the row was written without its rollup, drift that a rebuild fixes
+        self.assertEqual(total_plays(), 0)
+        DailyMetricRollup.objects.rebuild()
+        self.assertEqual(total_plays(), 1)
@@ -1,23 +1,54 @@
+import hashlib
 import logging
+import time
 import urllib
 from datetime import timedelta
 from django.conf import settings
 from django.core import signing
-from django.db import transaction
 from django.db.models import F
+from django.http import StreamingHttpResponse
 from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import generics, status, views
-from rest_framework.authentication import SessionAuthentication, TokenAuthentication
+from rest_framework.authentication import SessionAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from .models import UserVideoMetric
-from .serializers import MonthMetricsSerializer, UserVideoMetricSerializer
+from rest_framework.settings import api_settings
+from .authentication import CachedTokenAuthentication
+from .buffer import ping_buffer
+from .cache import archive_version, artist_version, bump_archive_versions
+from .export import CONTENT_TYPES, CSV, FORMATS, export_filename, export_lines, parse_dimensions
+from .models import ArtistEvent, DailyMetricRollup, PayoutSnapshot, UserVideoMetric, ingestion_atomic
+from .periods import DAY, GRANULARITIES, Period
+from .permissions import IsSuperUser
+from .pings import apply_pings
+from .profiling import ProfiledViewMixin, collect_stats, profiler, profiling_enabled
+from .ratelimit import (
+    FAILED_VALIDATION, RATE_LIMITED, ThrottledLogger, ping_rate_limiter, rate_limit_enabled, rejected_pings
+)
+from .renderers import ColumnarRenderer, columnar
+from .serializers import (
+    ArtistEventsSerializer, MonthMetricsSerializer, PayoutArtistShareSerializer, PayoutShareSerializer,
+    PayoutSnapshotSerializer, PingBatchItemSerializer, SeriesMetricsSerializer, UserVideoMetricSerializer
+)
+from .spool import ping_spool
 
 logger = logging.getLogger(__name__)
+rejection_log = ThrottledLogger(logger)
 
+INGESTION_LOCK = 'lock'
+INGESTION_UPSERT = 'upsert'
+INGESTION_BUFFER = 'buffer'
+INGESTION_SPOOL = 'spool'
 
-class MetricView(generics.CreateAPIView):
-    authentication_classes = (TokenAuthentication,)
+# how far ahead of the server's clock batched ping timestamps may be
+BATCH_CLOCK_SKEW = timedelta(minutes=1)
+
+
+class MetricView(ProfiledViewMixin, generics.CreateAPIView):
+    authentication_classes = (CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
     model = UserVideoMetric
     serializer_class = UserVideoMetricSerializer
@@ -30,10 +61,20 @@ class MetricView(generics.CreateAPIView):
         data = signing.loads(signed_data)
         if not self.headers_validation(request):
             return Response(status=status.HTTP_403_FORBIDDEN)
+        if not self.within_rate_limit(data):
+            return Response(status=status.HTTP_429_TOO_MANY_REQUESTS)
 
         serializer = self.get_serializer(data=data)
         serializer.is_valid(raise_exception=True)
-        with transaction.atomic():
+        mode = self.get_ingestion_mode()
+        if mode == INGESTION_SPOOL:
+            # replayed into the database by the drain_metric_spool command
+            ping_spool.append(data)
+            return Response(status=status.HTTP_202_ACCEPTED)
+        if mode in (INGESTION_UPSERT, INGESTION_BUFFER):
+            return Response(status=self.apply_ping(mode, serializer, request.user))
+
+        with ingestion_atomic():
             try:
                 now = timezone.now()
                 metric = UserVideoMetric.objects.select_for_update().get(
@@ -45,82 +86,528 @@ class MetricView(generics.CreateAPIView):
                 )
                 if self.passes_validation(now, metric, request.user):
                     http_status = status.HTTP_204_NO_CONTENT
+                    new_play = metric.last_ping + timedelta(hours=1) < now
                     metric.seconds_played = F('seconds_played') + settings.PING_INTERVAL
-                    if (metric.last_ping + timedelta(hours=1) < now):
+                    if new_play:
                         metric.play_count = F('play_count') + 1
                     metric.last_ping = now
                     metric.save()
+                    DailyMetricRollup.objects.add_ping(metric, settings.PING_INTERVAL, int(new_play))
                 else:
                     http_status = status.HTTP_403_FORBIDDEN
             except UserVideoMetric.DoesNotExist:
-                self.perform_create(serializer)
+                # the same day the row was looked up by, the field default would store a datetime
+                self.perform_create(serializer, date=now.date())
+                metric = serializer.instance
+                DailyMetricRollup.objects.add_ping(metric, metric.seconds_played, metric.play_count)
                 http_status = status.HTTP_201_CREATED
         return Response(status=http_status)
 
+    def get_ingestion_mode(self):
+        return getattr(settings, 'METRICS_INGESTION_MODE', INGESTION_LOCK)
+
+    def apply_ping(self, mode, serializer, user):
+        if mode == INGESTION_BUFFER:
+            applied = ping_buffer.add(serializer.validated_data)
+        else:
+            applied = UserVideoMetric.objects.upsert_ping(serializer.validated_data)
+        if applied is None:
+            self.log_rejection(user, serializer.validated_data.get('recording_id'))
+            return status.HTTP_403_FORBIDDEN
+        if applied['created']:
+            return status.HTTP_201_CREATED
+        return status.HTTP_204_NO_CONTENT
+
     def passes_validation(self, now, metric, user):
         allowed_ping_interval = (now >= (metric.last_ping + timedelta(seconds=settings.PING_INTERVAL_WITH_BUFFER)))
         less_than_daily_limit = metric.seconds_played < settings.DAILY_LIMIT_PER_MEDIA
         passes_validation = allowed_ping_interval and less_than_daily_limit
         if not passes_validation:
-            logger.warning("User {} failed validation, U_ID:{}, R_ID:{}, SEC:{}".format(
-                user.email, user.id, metric.recording_id, metric.seconds_played))
+            self.log_rejection(user, metric.recording_id, metric.seconds_played)
         return passes_validation
 
+    def within_rate_limit(self, data, now=None):
+        """
+        Whether the ping is within the listener's METRICS_RATE_LIMIT_ENABLED token bucket, checked
+        before it touches the database. now is the ping's time in epoch seconds, by default the
+        current time.
+        """
+        if not rate_limit_enabled():
+            return True
+        user_id, recording_id = data.get('user_id'), data.get('recording_id')
+        if ping_rate_limiter.allow(user_id, recording_id, now):
+            return True
+        rejected_pings.add(RATE_LIMITED)
+        rejection_log.warning((RATE_LIMITED, user_id, recording_id),
+                              "Rate limited pings, U_ID:{}, R_ID:{}".format(user_id, recording_id))
+        return False
+
+    def log_rejection(self, user, recording_id, seconds_played=None):
+        rejected_pings.add(FAILED_VALIDATION)
+        message = "User failed validation, U_ID:{}, R_ID:{}".format(user.id, recording_id)
+        if seconds_played is not None:
+            message += ", SEC:{}".format(seconds_played)
+        rejection_log.warning((FAILED_VALIDATION, user.id, recording_id), message)
+
     def headers_validation(self, request):
         host_header = request.META.get('HTTP_REFERER')
         host_header_valid = host_header and host_header.startswith(settings.SMALLSLIVE_SITE)
         return host_header_valid
 
-    def perform_create(self, serializer):
-        serializer.save()
+    def perform_create(self, serializer, **kwargs):
+        serializer.save(**kwargs)
 
 metric_view = MetricView.as_view()
 
 
-class EventCountsView(views.APIView):
-    authentication_classes = (TokenAuthentication,)
+class MetricBatchView(MetricView):
+    """
+    Takes {"pings": [{"signed_data": ..., "timestamp": ...}, ...]}, the pings a player buffered
+    or couldn't send while offline, each with the time it was taken (the time of the request by
+    default). They are validated in timestamp order and written in one transaction, and the
+    response has the status MetricView would have returned for every ping, in request order.
+    """
+
+    def create(self, request, *args, **kwargs):
+        if not self.headers_validation(request):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+        items = request.data.get('pings')
+        if not isinstance(items, list) or len(items) > getattr(settings, 'METRICS_BATCH_MAX_PINGS', 500):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        now, clock = timezone.now(), time.time()
+        statuses = [status.HTTP_400_BAD_REQUEST] * len(items)
+        pings = []
+        for index, item in enumerate(items):
+            ping = self.load_ping(item, now)
+            if ping is not None:
+                pings.append((ping[0], index, ping[1]))
+        pings.sort(key=lambda ping: ping[:2])
+
+        # every ping is charged to its listener's bucket at the time it was taken
+        within_limit = []
+        for timestamp, index, data in pings:
+            if self.within_rate_limit(data, clock - (now - timestamp).total_seconds()):
+                within_limit.append((timestamp, index, data))
+            else:
+                statuses[index] = status.HTTP_429_TOO_MANY_REQUESTS
+        pings = within_limit
+
+        with ingestion_atomic():
+            results = apply_pings([(timestamp, data) for timestamp, index, data in pings], for_update=True)
+        bump_archive_versions(set(timestamp.date() for timestamp, index, data in pings))
+
+        rejected = 0
+        for (timestamp, index, data), applied in zip(pings, results):
+            if applied is None:
+                statuses[index] = status.HTTP_403_FORBIDDEN
+                rejected += 1
+            elif applied['created']:
+                statuses[index] = status.HTTP_201_CREATED
+            else:
+                statuses[index] = status.HTTP_204_NO_CONTENT
+        if rejected:
+            rejected_pings.add(FAILED_VALIDATION, rejected)
+            rejection_log.warning(
+                (FAILED_VALIDATION, request.user.id),
+                "User failed validation for {} of {} batched pings, U_ID:{}".format(
+                    rejected, len(items), request.user.id))
+        return Response(data={'results': [{'status': item_status} for item_status in statuses]})
+
+    def load_ping(self, item, now):
+        """
+        Returns the (timestamp, validated_data) of a batch item, None if it's invalid or its
+        timestamp is more than METRICS_BATCH_MAX_AGE seconds old or ahead of the server's clock.
+        """
+        item_serializer = PingBatchItemSerializer(data=item)
+        if not item_serializer.is_valid():
+            return None
+        try:
+            data = signing.loads(item_serializer.validated_data['signed_data'])
+        except signing.BadSignature:
+            return None
+        serializer = self.get_serializer(data=data)
+        if not serializer.is_valid():
+            return None
+        timestamp = item_serializer.validated_data.get('timestamp', now)
+        max_age = timedelta(seconds=getattr(settings, 'METRICS_BATCH_MAX_AGE', 60 * 60))
+        if not now - max_age <= timestamp <= now + BATCH_CLOCK_SKEW:
+            return None
+        return timestamp, serializer.validated_data
+
+metric_batch_view = MetricBatchView.as_view()
+
+
+class ConditionalReportMixin(object):
+    """
+    Strong ETags and Cache-Control headers for reports of a period. The ETag only depends on the
+    request, the period's data version in the metrics cache and, while the period is still open,
+    the current METRICS_ARCHIVE_CACHE_TIMEOUT window, so a matching If-None-Match is answered with
+    a 304 before any metrics query runs.
+    """
+
+    def report_etag(self, period, *key):
+        version = archive_version(period.start.year, period.start.month)
+        parts = [self.__class__.__name__, self.request.accepted_renderer.format, period.start, period.end, version]
+        if not period.is_closed():
+            parts.append(int(time.time()) // self.open_max_age())
+        parts.extend(key)
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def open_max_age(self):
+        return max(getattr(settings, 'METRICS_ARCHIVE_CACHE_TIMEOUT', 60), 1)
+
+    def not_modified(self, request, etag):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        return request.method in ('GET', 'HEAD') and if_none_match and (
+            etag in parse_etags(if_none_match) or if_none_match.strip() == '*')
+
+    def conditional_response(self, request, period, etag, get_data):
+        """
+        Returns a 304 if the client has the etag, otherwise the data from get_data() (None if it's
+        invalid), with the caching headers set either way.
+        """
+        if self.not_modified(request, etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            data = get_data()
+            if data is None:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            response = Response(data=data)
+        if period.is_closed():
+            max_age = getattr(settings, 'METRICS_CLOSED_PERIOD_MAX_AGE', 24 * 60 * 60)
+        else:
+            max_age = self.open_max_age()
+        visibility = 'public' if getattr(settings, 'METRICS_HTTP_CACHE_PUBLIC', False) else 'private'
+        response['ETag'] = quote_etag(etag)
+        response['Cache-Control'] = '{0}, max-age={1}'.format(visibility, max_age)
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalReportMixin, self).finalize_response(request, response, *args, **kwargs)
+        # APIView sets Vary: Accept over whatever the view set, so this has to come after it
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
+
+class ColumnarReportMixin(object):
+    """
+    Adds the columnar format to a date_counts or date_series report. Its lists are returned as
+    columns sharing the dates axis, without the serializer validating them one element at a time,
+    as they are aggregates computed here rather than input.
+    """
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,)
+
+    def report_data(self, counts, serializer_class):
+        if self.request.accepted_renderer.format == ColumnarRenderer.format:
+            return columnar(counts)
+        s = serializer_class(data=counts)
+        if s.is_valid():
+            return s.data
+
+
+class EventCountsView(ProfiledViewMixin, ColumnarReportMixin, ConditionalReportMixin, views.APIView):
+    authentication_classes = (CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, format=None):
         try:
             month = int(request.query_params.get('month'))
             year = int(request.query_params.get('year'))
-        except TypeError:
+            period = Period.month(year, month)
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        granularity = request.query_params.get('granularity', DAY)
+        if granularity not in GRANULARITIES:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
         event_id = request.query_params.get('event_id')
+        etag = self.report_etag(period, granularity, event_id)
+        return self.conditional_response(request, period, etag, lambda: self.get_data(
+            month, year, event_id, granularity))
+
+    def get_data(self, month, year, event_id, granularity):
         if event_id:
-            counts = UserVideoMetric.objects.date_counts(month, year, [int(event_id)])
+            counts = UserVideoMetric.objects.date_counts(month, year, [int(event_id)], granularity)
         else:
-            counts = UserVideoMetric.objects.date_counts(month, year)
-        s = MonthMetricsSerializer(data=counts)
-        if s.is_valid():
-            return Response(data=s.data)
-        return Response(status=status.HTTP_400_BAD_REQUEST)
+            counts = UserVideoMetric.objects.archive_date_counts(month, year, granularity)
+        return self.report_data(counts, MonthMetricsSerializer)
 
 event_counts = EventCountsView.as_view()
 
 
-class ArtistCountsView(views.APIView):
-    authentication_classes = (TokenAuthentication,)
+def parse_artist_id(value):
+    """
+    The artist_id parameter of the artist reports as an int, None if it's missing.
+    """
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+class EventTotalsView(ProfiledViewMixin, ConditionalReportMixin, views.APIView):
+    """
+    The counts_for_event report of the events given as repeated event_id parameters, or of the
+    events of an artist_id, as a list in request order. humanize=1 adds the time played.
+    """
+    authentication_classes = (CachedTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, format=None):
+        try:
+            event_ids = [int(event_id) for event_id in request.query_params.getlist('event_id')]
+            artist_id = parse_artist_id(request.query_params.get('artist_id'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if artist_id is None and not event_ids:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if len(event_ids) > getattr(settings, 'METRICS_EVENT_TOTALS_MAX_EVENTS', 500):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        humanize = request.query_params.get('humanize') in ('1', 'true')
+
+        # the week and all-time counts change along with the current month's
+        period = Period.month()
+        if artist_id is not None:
+            etag = self.report_etag(period, humanize, 'artist', artist_id, artist_version(artist_id))
+        else:
+            etag = self.report_etag(period, humanize, event_ids)
+        return self.conditional_response(request, period, etag, lambda: self.get_data(
+            event_ids, artist_id, humanize))
+
+    def get_data(self, event_ids, artist_id, humanize):
+        if artist_id is not None:
+            event_ids = sorted(ArtistEvent.objects.event_ids(artist_id))
+        counts = UserVideoMetric.objects.counts_for_events(event_ids, humanize)
+        return {'events': [dict(counts[event_id], event_id=event_id) for event_id in event_ids]}
+
+event_totals = EventTotalsView.as_view()
+
+
+class ArtistCountsView(ProfiledViewMixin, ColumnarReportMixin, ConditionalReportMixin, views.APIView):
+    """
+    Accepts the month, year and either an artist_id, whose events are looked up in ArtistEvent,
+    or the event_ids as POST data or, so browsers and caches can revalidate them, as GET
+    parameters with repeated event_id parameters.
+    """
+    authentication_classes = (CachedTokenAuthentication,)
     permission_classes = (IsAuthenticated,)
 
+    def get(self, request, format=None):
+        try:
+            month = int(request.query_params.get('month'))
+            year = int(request.query_params.get('year'))
+            event_ids = [int(event_id) for event_id in request.query_params.getlist('event_id')]
+            artist_id = parse_artist_id(request.query_params.get('artist_id'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        return self.counts(request, month, year, event_ids, request.query_params.get('granularity', DAY),
+                           artist_id)
+
     def post(self, request, format=None):
         try:
             month = int(request.data.get('month'))
             year = int(request.data.get('year'))
             event_ids = request.data.get('event_ids')
-        except TypeError:
+            artist_id = parse_artist_id(request.data.get('artist_id'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        return self.counts(request, month, year, event_ids, request.data.get('granularity', DAY), artist_id)
+
+    def counts(self, request, month, year, event_ids, granularity, artist_id=None):
+        try:
+            period = Period.month(year, month)
+        except ValueError:
             return Response(status=status.HTTP_400_BAD_REQUEST)
+        if granularity not in GRANULARITIES:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if artist_id is not None:
+            etag = self.report_etag(period, granularity, 'artist', artist_id, artist_version(artist_id))
+            event_ids = ArtistEvent.objects.event_ids(artist_id)
+        else:
+            etag = self.report_etag(period, granularity, sorted(event_ids) if event_ids else event_ids)
+        return self.conditional_response(request, period, etag, lambda: self.get_data(
+            month, year, event_ids, granularity))
 
-        counts = UserVideoMetric.objects.date_counts(month, year, event_ids)
-        archive_counts = UserVideoMetric.objects.date_counts(month, year)
+    def get_data(self, month, year, event_ids, granularity):
+        counts = UserVideoMetric.objects.date_counts(month, year, event_ids, granularity)
+        archive_counts = UserVideoMetric.objects.archive_date_counts(month, year, granularity)
         for key, val in archive_counts.items():
             new_key = "archive_" + key
             counts[new_key] = val
-        s = MonthMetricsSerializer(data=counts)
-        if s.is_valid():
-            return Response(data=s.data)
-        return Response(status=status.HTTP_400_BAD_REQUEST)
+        return self.report_data(counts, MonthMetricsSerializer)
 
 artist_counts = ArtistCountsView.as_view()
+
+
+class EventSeriesView(ProfiledViewMixin, ColumnarReportMixin, views.APIView):
+    """
+    Plays and minutes between the start and end dates (YYYY-MM-DD, both included) per day, week
+    or month, for the whole archive, the events given as repeated event_id parameters or the
+    events of an artist_id.
+    """
+    authentication_classes = (CachedTokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, format=None):
+        try:
+            start_date = parse_date(request.query_params.get('start'))
+            end_date = parse_date(request.query_params.get('end'))
+            event_ids = [int(event_id) for event_id in request.query_params.getlist('event_id')]
+            artist_id = parse_artist_id(request.query_params.get('artist_id'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if artist_id is not None:
+            event_ids = ArtistEvent.objects.event_ids(artist_id)
+        granularity = request.query_params.get('granularity', DAY)
+        max_days = getattr(settings, 'METRICS_SERIES_MAX_DAYS', 3660)
+        if (not start_date or not end_date or granularity not in GRANULARITIES or
+                end_date < start_date or (end_date - start_date).days >= max_days):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        counts = UserVideoMetric.objects.date_series(start_date, end_date, granularity, event_ids)
+        counts['granularity'] = granularity
+        data = self.report_data(counts, SeriesMetricsSerializer)
+        if data is None:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        return Response(data=data)
+
+event_series = EventSeriesView.as_view()
+
+
+class MetricExportView(views.APIView):
+    """
+    Streams the seconds_played and play_count between the start and end dates (YYYY-MM-DD, both
+    included) summed by the repeated dimension parameters (date, event_id and recording_id by
+    default), as CSV or, with output=ndjson, one JSON object per line. Can be limited to the
+    events given as repeated event_id parameters or the events of an artist_id.
+    """
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        try:
+            start_date = parse_date(request.query_params.get('start'))
+            end_date = parse_date(request.query_params.get('end'))
+            dimensions = parse_dimensions(request.query_params.getlist('dimension'))
+            event_ids = [int(event_id) for event_id in request.query_params.getlist('event_id')] or None
+            artist_id = parse_artist_id(request.query_params.get('artist_id'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        output = request.query_params.get('output', CSV)
+        if not start_date or not end_date or end_date < start_date or output not in FORMATS:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if artist_id is not None:
+            event_ids = ArtistEvent.objects.event_ids(artist_id)
+
+        period = Period.between(start_date, end_date)
+        response = StreamingHttpResponse(export_lines(period, dimensions, event_ids, output),
+                                         content_type=CONTENT_TYPES[output])
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(export_filename(period, output))
+        return response
+
+metric_export = MetricExportView.as_view()
+
+
+class PayoutSharesView(ProfiledViewMixin, views.APIView):
+    """
+    The payout snapshot of a month: its totals and the shares of the events given as repeated
+    event_id parameters or of the artists given as repeated artist_id parameters, each read by
+    its unique key. Ids without plays that month get zero counts. 404 until the month's snapshot
+    is taken.
+    """
+    authentication_classes = (CachedTokenAuthentication,)
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        try:
+            month = Period.month(int(request.query_params.get('year')), int(request.query_params.get('month')))
+            event_ids = [int(event_id) for event_id in request.query_params.getlist('event_id')]
+            artist_ids = [int(artist_id) for artist_id in request.query_params.getlist('artist_id')]
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if len(event_ids) + len(artist_ids) > getattr(settings, 'METRICS_EVENT_TOTALS_MAX_EVENTS', 500):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        snapshot = PayoutSnapshot.objects.filter(month=month.start).first()
+        if snapshot is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        data = PayoutSnapshotSerializer(snapshot).data
+        if event_ids:
+            data['events'] = self.shares(snapshot.shares, 'event_id', event_ids, PayoutShareSerializer)
+        if artist_ids:
+            data['artists'] = self.shares(snapshot.artist_shares, 'artist_id', artist_ids, PayoutArtistShareSerializer)
+        return Response(data=data)
+
+    def shares(self, qs, key, ids, serializer_class):
+        shares = dict((getattr(share, key), share) for share in qs.filter(**{key + '__in': ids}))
+        return [
+            serializer_class(shares[id_]).data if id_ in shares else
+            {key: id_, 'seconds_played': 0, 'play_count': 0, 'share': 0.0}
+            for id_ in ids
+        ]
+
+payout_shares = PayoutSharesView.as_view()
+
+
+class ArtistEventsView(views.APIView):
+    """
+    The events of an artist: GET ?artist_id= lists them, PUT {"artist_id": ..., "event_ids": [...]}
+    replaces them. Used by the main site to keep ArtistEvent in sync.
+    """
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        try:
+            artist_id = int(request.query_params.get('artist_id'))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        event_ids = sorted(ArtistEvent.objects.event_ids(artist_id))
+        return Response(data={'artist_id': artist_id, 'event_ids': event_ids})
+
+    def put(self, request, format=None):
+        serializer = ArtistEventsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        changed = ArtistEvent.objects.set_events(
+            serializer.validated_data['artist_id'], serializer.validated_data['event_ids'])
+        return Response(data={'changed': changed})
+
+artist_events = ArtistEventsView.as_view()
+
+
+class ProfileStatsView(views.APIView):
+    """
+    The histograms recorded with METRICS_PROFILING, merged over the processes that dump them to
+    METRICS_PROFILE_DIR. DELETE resets this process's histograms.
+    """
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        return Response(data={'enabled': profiling_enabled(), 'calls': collect_stats()})
+
+    def delete(self, request, format=None):
+        profiler.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+profile_stats = ProfileStatsView.as_view()
+
+
+class RejectedPingsView(views.APIView):
+    """
+    The pings rejected by the rate limiter and by validation, counted over all the processes when
+    METRICS_RATE_LIMIT_CACHE_ALIAS is set, otherwise by this one. DELETE resets the counts.
+    """
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (IsSuperUser,)
+
+    def get(self, request, format=None):
+        return Response(data={'rate_limit_enabled': rate_limit_enabled(), 'rejected': rejected_pings.counts()})
+
+    def delete(self, request, format=None):
+        rejected_pings.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+rejected_pings_stats = RejectedPingsView.as_view()